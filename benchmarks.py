@@ -0,0 +1,232 @@
+'''
+Benchmarks for the parts of ix that matter on very large trees.
+
+Run all of them with `python benchmarks.py`, or only
+some of them by name: `python benchmarks.py file_memory`
+'''
+import sys, os, re, time, tempfile, tracemalloc
+
+# ix reads the command line when imported
+# so keep the benchmark names to ourselves
+selected = sys.argv[1:]
+sys.argv = sys.argv[:1]
+
+import ix
+from ix import File, Parser, Template, Helpers, Palette
+
+
+
+class LegacyFile:
+    '''
+    The layout 'File' had before it was slotted: a per instance
+    dictionary, a dictionary of bound field parsers and separate
+    flag attributes. Only kept here to compare against.
+    '''
+    def __init__(self, root, name, notation = '#', rules = None) -> None:
+        self.original_path = root + '/' + name
+        self.name = name
+        self.notation = notation
+        self.hash = ''
+        self.rules = rules
+        self.dependencies = {}
+
+        self.has_custom_dir = False
+        self.has_custom_name = False
+        self.has_custom_access = False
+
+        self.to = root
+        self.prefix = '#'
+        self.access = ''
+
+        self.fields = {
+            'to': self.set_to,
+            'out': self.set_to,
+            'as': self.set_as,
+            'name': self.set_as,
+            'prefix': self.set_prefix,
+            'access': self.set_access
+        }
+
+    def set_to(self, data): self.has_custom_dir = True; self.to = data
+    def set_as(self, data): self.has_custom_name = True; self.name = data
+    def set_prefix(self, data): self.prefix = data
+    def set_access(self, data): self.has_custom_access = True; self.access = int(data, 8)
+
+
+
+def measure(create, amount):
+    '''
+    Find out how many bytes each of the objects returned
+    by the given function takes, on average.
+    '''
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+
+    objects = [ create(i) for i in range(amount) ]
+
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del objects
+    return (after - before) / amount
+
+
+
+def bench_file_memory(amount = 100000):
+    '''
+    Memory used by each file record, the way 'find_ix' creates them.
+    '''
+    ix.config = ix.read_config([])
+    digest = 'd41d8cd98f00b204e9800998ecf8427e'
+
+    def legacy(i):
+        file = LegacyFile('/home/user/dots/config', f'file{i}', '#:')
+        file.fields['to']('/home/user/.config/app')
+        file.hash = digest
+        return file
+
+    def slotted(i):
+        file = File('/home/user/dots/config', f'file{i}', '#:')
+        file.load_field(('to', '/home/user/.config/app'))
+        file.hash = digest
+        return file
+
+    before = measure(legacy, amount)
+    after = measure(slotted, amount)
+
+    print(f'file_memory: {amount} files')
+    print(f'\tbefore: {before:.0f} bytes per file')
+    print(f'\tafter:  {after:.0f} bytes per file ({after / before:.0%})')
+
+
+
+def legacy_render(path, prefix):
+    '''
+    Rendering the way it was done before it worked on bytes: the
+    whole file decoded to text, split up, joined, and encoded again
+    when written. Only kept here to compare against.
+    '''
+    with open(path, 'r') as f:
+        string = f.read()
+
+    pattern = re.compile('{}(.+?){}'.format(re.escape(prefix + ix.sequence[0]), re.escape(ix.sequence[1])))
+    pieces = pattern.split(string)
+
+    for index in range(1, len(pieces), 2):
+        pieces[index] = Parser.get_main_key_value(pieces[index]) or pieces[index]
+
+    return ''.join(pieces)
+
+
+
+def bench_render_bytes(megabytes = 64):
+    '''
+    Throughput of rendering and saving a large file that's mostly
+    plain text, with a variable every few kilobytes.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        with open(directory + '/ixrc', 'w') as f:
+            f.write('[data]\nvalue = replaced\n')
+
+        ix.config = ix.read_config(directory + '/ixrc')
+        chunk = ('plain text that stays the same ' * 128)[:4000] + ' #{{ data.value }}\n'
+
+        with open(directory + '/source', 'w') as f:
+            for _ in range(megabytes * 1024 * 1024 // len(chunk)):
+                f.write(chunk)
+
+        size = os.path.getsize(directory + '/source') / 1024 / 1024
+
+        def text():
+            with open(directory + '/text', 'w') as f:
+                f.write(legacy_render(directory + '/source', '#'))
+
+        def raw(threshold):
+            ix.map_threshold = threshold
+
+            # There's no header to remove, same as
+            # files that come from a rules file
+            file = File(directory, 'source')
+            file.rules = True
+            processed = file.render()
+
+            with open(directory + '/raw', 'wb') as f:
+                f.writelines(processed if isinstance(processed, list) else [ processed ])
+
+        timings = {}
+        threshold = ix.map_threshold
+
+        for name, render in [ ('text', text), ('bytes', lambda: raw(float('inf'))), ('mapped', lambda: raw(0)) ]:
+            started = time.perf_counter()
+            render()
+            timings[name] = time.perf_counter() - started
+
+        ix.map_threshold = threshold
+
+    print(f'render_bytes: {size:.0f} MB file')
+    print(f'\ttext:   {size / timings["text"]:.0f} MB/s')
+    print(f'\tbytes:  {size / timings["bytes"]:.0f} MB/s ({timings["text"] / timings["bytes"]:.1f}x)')
+    print(f'\tmapped: {size / timings["mapped"]:.0f} MB/s ({timings["text"] / timings["mapped"]:.1f}x)')
+
+
+
+def bench_palette(colors = 256, references = 5000, files = 20):
+    '''
+    Rendering files full of color helpers, with the colors parsed
+    from strings every time compared to served from the palette.
+    '''
+    variants = [ 'rgb {}', 'rgb {}; alpha: 0.5', 'hex {}', 'hex {}; alpha: 0.3', 'hex {}; argb: true; alpha: 0.8' ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(directory + '/ixrc', 'w') as f:
+            f.write('[colors]\n')
+
+            for i in range(colors):
+                if i % 2:
+                    f.write(f'color{i} = #{i:02x}{255 - i:02x}{i // 2:02x}\n')
+                else:
+                    f.write(f'color{i} = rgba({i}, {255 - i}, {i // 2}, 0.{i % 10})\n')
+
+        ix.config = ix.read_config(directory + '/ixrc')
+
+    contents = ''.join(
+        '#{{ ' + variants[i % len(variants)].format(f'colors.color{i % colors}') + ' }}\n'
+        for i in range(references)
+    ).encode()
+
+    find = Palette.find
+    pure = Helpers.pure
+
+    def render():
+        Helpers.memo.clear()
+        Helpers.registry.clear()
+
+        for _ in range(files):
+            Template(contents, '#').render()
+
+    timings = {}
+
+    for name, palette, memoized in [ ('strings', False, False), ('palette', True, False), ('memoized', True, True) ]:
+        Palette.find = find if palette else staticmethod(lambda value: None)
+        Helpers.pure = pure if memoized else ()
+
+        started = time.perf_counter()
+        render()
+        timings[name] = time.perf_counter() - started
+
+    Palette.find = find
+    Helpers.pure = pure
+
+    print(f'palette: {colors} colors, {references} references in each of {files} files')
+    print(f'\tstrings:  {timings["strings"] * 1000:.0f} ms')
+    print(f'\tpalette:  {timings["palette"] * 1000:.0f} ms ({timings["strings"] / timings["palette"]:.1f}x)')
+    print(f'\tmemoized: {timings["memoized"] * 1000:.0f} ms ({timings["strings"] / timings["memoized"]:.1f}x)')
+
+
+if __name__ == '__main__':
+    benchmarks = { name[6:]: value for name, value in globals().items() if name.startswith('bench_') }
+
+    for name in selected or benchmarks:
+        started = time.perf_counter()
+        benchmarks[name]()
+        print(f'\ttook {time.perf_counter() - started:.2f}s\n')
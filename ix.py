@@ -1,6 +1,8 @@
-import os, configparser, argparse
-import re, threading, json, hashlib
-import pathlib
+import os, sys, configparser, argparse
+import re, threading, queue, json, hashlib, heapq, itertools, struct, collections, atexit
+import pathlib, tempfile, time, shutil, asyncio, glob, mmap
+import tarfile, zipfile, io, importlib.util
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, Future, TimeoutError as FutureTimeout
 from datetime import datetime
 
 
@@ -10,6 +12,21 @@ from datetime import datetime
 verbose = False
 
 
+# Statistics about the current run
+# Get's exported when using the '--metrics' flag
+stats = {
+    'discovered': 0,
+    'rendered': 0,
+    'unchanged': 0,
+    'failed': 0,
+    'removed': 0,
+    'unmatched': 0,
+    'timed_out': 0,
+    'bytes_written': 0
+}
+stats_lock = threading.Lock()
+
+
 # Colors
 RED     = '\x1B[31;1m'
 CYAN    = '\x1B[36m'
@@ -27,38 +44,31 @@ MAGENTA = '\x1B[35;1m'
 #   \___|_|\__,_|___/___/\___||___/
 # -------------------------------------------------------------------------
 class Parser:
+    # Files that couldn't be read, or whose header couldn't be
+    # loaded, so it's unknown whether they're still ix compatible
+    unreadable = set()
+
+
     @staticmethod
     def get_config_key(key):
         '''
         Given a key of the format 'key.value', find out what the
-        value for the variable of that format is within the ix config
+        value for the variable of that format is within the ix config.
+
+        Values already have their environment variables expanded, since
+        that's done once, when the config is loaded.
         '''
         try:
             k, v = key.strip().split('.', 1)
-            return config[k][v]
-        except:
-            return None
-
-
-
-    @staticmethod
-    def get_secondary_key_value(key):
-        '''
-        Unwrap whether or not a configuration value exists
-        for the given key.
-
-        Parameters:
-            key (str): The key to look for
+            v = config.optionxform(v)
 
-        Returns:
-            str: The value, or null
-        '''
-        value = Parser.get_config_key(key)
-
-        if not value:
+            Environment.use(config.environment[f'{k}.{v}'])
+            value = config.resolved[f'{k}.{v}']
+        except:
             return None
 
-        return os.path.expandvars(value)
+        Includes.reference(f'{k}.{v}')
+        return value
 
 
 
@@ -82,98 +92,49 @@ class Parser:
             value = Parser.get_config_key(key)
             if not value: return None
 
-            return os.path.expandvars(value)
+            return value
 
         # Check for helpers
-        helper, parameters = stripped.split(' ', 1)
-        parameters = [ param.strip() for param in parameters.split(';') ]
-        
-        # First argument doesn't have a name
-        main = parameters.pop(0)
-        main = Parser.get_config_key(main) or main
-
-        modifier_keys = list()
-        modifier_values = list()
-
-        for param in parameters:
-            name, value = param.split(':')
-
-            name = name.strip()
-            value = value.strip()
-
-            modifier_keys.append(name)
-            modifier_values.append(Parser.get_config_key(value) or value)
-
-        modifiers = dict(zip(modifier_keys, modifier_values))
+        helper, main, modifiers = Parser.get_helper_arguments(stripped)
         value = Helpers.call(helper, main, modifiers)
             
-        return os.path.expandvars(value)
+        return Environment.expand(value)
 
 
 
     @staticmethod
-    def parse_secondary_keys(string, prefix):
+    def get_helper_arguments(key):
         '''
-        Find secondary variables within a file ( these are variables within main variables ),
-        denoted by '[]', and look whether or not they have a defined value inside the configuration
-        file.
-
-        If they do, replace the variable with the value from the configuration.
+        Split a key that uses a helper into the name of the helper,
+        the value to run it on, and the modifiers, with every one of
+        them replaced by its value in the config if it has one.
 
         Parameters:
-            string (str): The data we want to look through for variables
-            prefix (str): What prefix the parent variables are denoted by
-        '''
-        pattern = re.compile('%s{{.+\\[(.+?)\\].+}}' % re.escape(prefix), re.MULTILINE)
-        items = set(re.findall(pattern, string))
-        unmatched = None
-
-        contents = string
-
-        for key in items:
-            value = Parser.get_secondary_key_value(key)
-
-            if not value:
-                if not unmatched: unmatched = []
-                unmatched.append(f'[{key}]')
-                continue
-
-            contents = contents.replace(f'[{ key }]', value)
-
-        return ( contents, unmatched )
+            key (str): The key, in the format 'helper value; name: value'
 
-
-
-    @staticmethod
-    def parse_main_keys(string, prefix):
+        Returns:
+            tuple: The helper, the value, and a dict of the modifiers
         '''
-        Find main variables within a file ( something like ${{}} ) and look
-        whether or not they have a defined value inside the configuration file.
-
-        If they do, repalce the variable with the value from the configuration.
+        helper, parameters = key.split(' ', 1)
+        parameters = [ param.strip() for param in parameters.split(';') ]
 
-        Parameters:
-            string (str): The data we want to look through for variables
-            prefix (str): What prefix the variables are denoted by
-        '''
-        pattern = re.compile('%s{{(.+?)}}' % re.escape(prefix), re.MULTILINE)
-        items = set(re.findall(pattern, string))
-        unmatched = None
+        # First argument doesn't have a name
+        main = parameters.pop(0)
+        main = Parser.get_config_key(main) or main
 
-        contents = string
+        modifier_keys = list()
+        modifier_values = list()
 
-        for key in items:
-            full_key = '{}{}{}{}'.format(prefix, sequence[0], key, sequence[1])
-            value = Parser.get_main_key_value(key)
+        for param in parameters:
+            name, value = param.split(':')
 
-            if not value:
-                if not unmatched: unmatched = []
-                unmatched.append(full_key)
-                continue
+            name = name.strip()
+            value = value.strip()
 
-            contents = contents.replace(full_key, value)
+            modifier_keys.append(name)
+            modifier_values.append(Parser.get_config_key(value) or value)
 
-        return (contents, unmatched)
+        return (helper, main, dict(zip(modifier_keys, modifier_values)))
 
 
 
@@ -194,15 +155,8 @@ class Parser:
             contents (str): The original content with all the variables replaced
             unmatched (list): The keys for all the variables that couldn't be matched within the string
         '''
-        contents, unmatched_secondary = Parser.parse_secondary_keys(string, prefix)
-        contents, unmatched_main = Parser.parse_main_keys(contents, prefix)
-
-        if not unmatched_secondary: unmatched_secondary = []
-        if not unmatched_main: unmatched_main = []
-
-        unmatched = unmatched_main + unmatched_secondary
-
-        return (contents, unmatched)
+        contents, unmatched = Template(string, prefix).render()
+        return (decode(contents), unmatched)
 
 
 
@@ -221,11 +175,14 @@ class Parser:
         '''
         root, name = file_path.rsplit('/', 1)
 
-        file = get_file_lines(file_path)
-        if not file:
+        # Large files are mapped once, and the same
+        # mapping is used for everything else
+        source = map_file(file_path)
+
+        lines = get_file_lines(file_path, source)
+        if not lines:
             return None
 
-        lines = list(file)
         found = False
         current = None
 
@@ -247,7 +204,7 @@ class Parser:
 
                     clean = line.replace(start, '').strip()
 
-                    if clean.startswith(tuple(current.fields)):
+                    if clean.startswith(File.names):
                         field, data = clean.split(':', 1)
                         current.load_field((field, data))
                         continue
@@ -255,35 +212,104 @@ class Parser:
             if idx == 20 and not found:
                 return None
 
+        if current:
+            current.source = source or False
+
         return current
 
 
 
     @staticmethod
-    def find_ix(root):
+    def walk(root):
         '''
-        Find all files that contain the 'ix' trigger so we know what
-        needs parsing.
+        Go through every file in the given directory, one by one,
+        skipping the ones that were created by ix itself. When the
+        git index is used, the repository itself is skipped as well.
 
         Parameters:
             root (str): The directory to look into for files
 
         Returns:
-            list: All the files in the directory that contain the trigger
+            generator: The path of every file in the directory
         '''
-        ix_files = []
+        for root, directories, files in os.walk(root):
+            if Git.entries is not None and '.git' in directories:
+                directories.remove('.git')
 
-        for root, _, files in os.walk(root):
             for name in files:
                 if name.endswith('.ix'): continue
 
-                full_path = root + '/' + name
-                file = Parser.wrap_file(full_path)
+                yield root + '/' + name
+
+
+
+    @staticmethod
+    def sniff(item):
+        '''
+        Wrap the given path if it's an ix compatible file. Items that
+        are already wrapped ( like the ones coming from a rules file )
+        are passed along as they are.
+
+        Parameters:
+            item (str/File): The path to the file, or the file itself
+
+        Returns:
+            File: The wrapped file, or None if it's not ix compatible
+        '''
+        try:
+            return Parser.__sniff(item)
+        except Exception:
+            Parser.unreadable.add(getattr(item, 'original_path', item))
+            raise
+
+
+    @staticmethod
+    def __sniff(item):
+        if isinstance(item, File):
+            item.blob = Git.blob(item.original_path)
+            return item
+
+        blob = Git.blob(item)
+
+        # Files that are exactly as they are in the git index
+        # were already looked at, as long as the same contents were
+        if blob and blob in Git.sniffed:
+            header = Git.sniffed[blob]
+
+            if header is None:
+                return None
+
+            root, name = item.rsplit('/', 1)
+            file = File(root, name, header[0])
+
+            for field in header[1]:
+                file.load_field(tuple(field))
+        else:
+            file = Parser.wrap_file(item)
+
+            if blob:
+                Git.remember(blob, file)
+
+        if file:
+            file.blob = blob
+
+        return file
+
 
-                if file:
-                    ix_files.append(file)
 
-        return ix_files
+    @staticmethod
+    def find_ix(root):
+        '''
+        Find all files that contain the 'ix' trigger so we know what
+        needs parsing.
+
+        Parameters:
+            root (str): The directory to look into for files
+
+        Returns:
+            list: All the files in the directory that contain the trigger
+        '''
+        return [ file for file in map(Parser.wrap_file, Parser.walk(root)) if file ]
 
 
 
@@ -300,24 +326,112 @@ class Parser:
         Parameters:
             file (File): The file object to parse
         '''
-        processed = file.parse()
+        processed = Parser.render(file)
 
-        if not file.rules:
-            regex = re.compile('^{}.+[\\s\\S]$'.format(file.notation), re.MULTILINE)
-            for line in re.findall(regex, processed):
-                processed = processed.replace(line, '')
+        if processed is not None and Parser.save_file(file, processed):
+            Parser.record_file(file)
+
+
+
+    @staticmethod
+    def render(file, contents = None):
+        '''
+        Render the given file within the time it's allowed to take, giving
+        up on it if it takes any longer. Files that run out of time are
+        reported and never saved, so they get another chance next run.
+
+        Parameters:
+            file (File): The file object to render
+            contents (bytes): The contents of the file, if they were already read
+
+        Returns:
+            bytes/list: The processed contents, or None if the file ran out of time
+        '''
+        if Budget.deadline is not None and time.monotonic() >= Budget.deadline:
+            warn(f'Skipped, the run is out of time ---- { file.original_path }')
+            count('timed_out')
+            return None
 
         try:
-            with open(file.get_output_path(), 'w') as f:
-                f.write(processed)
+            return Budget.run(lambda: file.render(contents), Budget.file)
+        except TimedOut as e:
+            error(f'Timed out{ e } ---- { file.original_path }', True)
+            count('timed_out')
+            return None
 
-            if file.has_custom_access:
-                os.chmod(file.get_output_path(), file.access)
 
-            lock_file[file.original_path] = file.to_dict()
+
+    @staticmethod
+    def save_file(file, processed):
+        '''
+        Write the processed contents of a file to its output path,
+        creating the output directory if needed.
+
+        Parameters:
+            file (File): The file object that was processed
+            processed (bytes/list): The processed contents, or the pieces of them
+
+        Returns:
+            File: The file, or None if it couldn't be saved
+        '''
+        path = destination(file.get_output_path())
+
+        # Mapped files come in pieces, only join them
+        # when there's no way to write them one by one
+        if isinstance(processed, list) and (Bundle.archive or use_store):
+            processed = b''.join(processed)
+
+        if Bundle.archive:
+            Bundle.add(path, processed, file.access if file.has_custom_access else None)
+            count('bytes_written', len(processed))
+            return file
+
+        # If the directory we're saving to does not exist
+        # we want to create it.
+        Directories.create(os.path.dirname(path), file.name)
+
+        try:
+            if use_store:
+                file.output_digest = Store.materialize(path, processed, file.access if file.has_custom_access else None)
+                return file
+
+            with open(path, 'wb') as f:
+                if isinstance(processed, list):
+                    f.writelines(processed)
+                else:
+                    f.write(processed)
+
+            if file.has_custom_access:
+                os.chmod(path, file.access)
         except FileNotFoundError:
             error('Could not find output path: {}.\n\tUsed in file: {}'.format(file.get_output_path(), file.original_path), True)
-            return
+            count('failed')
+            return None
+
+        count('bytes_written', sum(map(len, processed)) if isinstance(processed, list) else len(processed))
+
+        return file
+
+
+
+    @staticmethod
+    def record_file(file):
+        '''
+        Add a file that was saved to the lock file so we don't have
+        to process it again unless it's contents change.
+
+        Parameters:
+            file (File): The file object that was saved
+        '''
+        before = lock_file.get(file.original_path) or {}
+        entry = lock_file[file.original_path] = file.to_dict()
+        count('rendered')
+
+        if Index.directory:
+            Index.update(file.original_path, entry['output'], before.get('keys', ()), entry['keys'])
+
+        # Whatever was mapped isn't needed anymore
+        file.source = None
 
         success('Saved: {1}{2}{0} to {1}{3}'.format(WHITE, RESET, file.original_path, file.get_output_path()), True)
 
@@ -330,23 +444,171 @@ class Helpers:
 
     Helpers can only be used within main variables, aka. '${{ thing.thing }}'
 
+    Besides the ones below, every python file within the helpers directory
+    ( $HOME/.config/ix/helpers by default ) is a helper with the same name,
+    only imported the first time a file uses it. It should define a function
+    with the same name as the file, that takes the value and the modifiers.
+    It can also define:
+
+        pure = True                         The result only depends on the arguments,
+                                            so it only has to be worked out once per run
+        def batch(values, **modifiers)      Convert a list of values at once, used
+                                            for every value within a file if pure
+
     Parameters:
         helper (str): The name of the helper function to run
         value (str/int): The value to perform the function on
         modifiers (dict): Extra parameters passed to the helper to further tweak the value
     '''
+    builtin = ('rgb', 'hex', 'include', 'uppercase', 'lowercase')
+    pure = ('rgb', 'hex')
+
+    # Every helper that was asked for, as (function, pure, batch),
+    # or None if there's no such helper
+    registry = {}
+
+    # The helpers directory, as { name: path }, once it was looked at
+    available = None
+
+    # Results of pure helpers
+    memo = {}
+
+    lock = threading.RLock()
+
+
+    @staticmethod
+    def find(helper):
+        '''
+        Get a helper by its name, importing it if it's
+        the first time it's used.
+
+        Returns:
+            tuple: The function, whether it's pure, and the batch function if any
+        '''
+        if helper in Helpers.registry:
+            return Helpers.registry[helper]
+
+        with Helpers.lock:
+            if helper not in Helpers.registry:
+                if helper in Helpers.builtin:
+                    entry = (getattr(Helpers, helper), helper in Helpers.pure, None)
+                else:
+                    entry = Helpers.load(helper)
+
+                Helpers.registry[helper] = entry
+
+        return Helpers.registry[helper]
+
+
+    @staticmethod
+    def load(helper):
+        '''
+        Import a helper from the helpers directory.
+
+        Returns:
+            tuple: The function, whether it's pure, and the batch function if any
+        '''
+        if Helpers.available is None:
+            try:
+                Helpers.available = {
+                    name[:-3]: os.path.join(helpers_path, name)
+                    for name in os.listdir(helpers_path) if name.endswith('.py')
+                }
+            except OSError:
+                Helpers.available = {}
+
+        path = Helpers.available.get(helper)
+
+        if not path:
+            return None
+
+        try:
+            spec = importlib.util.spec_from_file_location(f'ix_helpers.{helper}', path)
+            module = importlib.util.module_from_spec(spec)
+
+            # Run the source directly, importing it would
+            # write bytecode into the helpers directory
+            with open(path, 'rb') as f:
+                exec(compile(f.read(), path, 'exec'), module.__dict__)
+
+            return (getattr(module, helper), bool(getattr(module, 'pure', False)), getattr(module, 'batch', None))
+        except Exception as e:
+            error(f'{e!r} ---- while loading helper: {path}', True)
+            return None
+
+
     @staticmethod
     def call(helper, value, modifiers):
         '''
         Call a specific helper, if defined
         '''
+        entry = Helpers.find(helper)
+
+        if not entry:
+            error(f'Unknown helper ---- helper: {helper}')
+            return ''
+
+        method, pure, _ = entry
+        key = (helper, value, tuple(sorted(modifiers.items())))
+
+        if pure and key in Helpers.memo:
+            return Helpers.memo[key]
+
         try:
-            method = getattr(Helpers, helper)
-            return method(value, **modifiers)
+            result = Budget.limit(lambda: method(value, **modifiers), Budget.helper, f' in helper: {helper}')
+        except TimedOut:
+            raise
         except Exception as e:
             error(f'{e!r} ---- helper: {helper}')
             return ''
 
+        if pure:
+            Helpers.memo[key] = result
+
+        return result
+
+
+    @staticmethod
+    def batch(helper, values, modifiers):
+        '''
+        Call a specific helper for many values at once, with the same
+        modifiers. Results of pure helpers are remembered, so calling
+        the helper for any of the values later doesn't run it again.
+
+        Returns:
+            list: The result for each of the values
+        '''
+        entry = Helpers.find(helper)
+
+        if not entry or not entry[2]:
+            return [ Helpers.call(helper, value, modifiers) for value in values ]
+
+        _, pure, batch = entry
+        values = list(values)
+        options = tuple(sorted(modifiers.items()))
+
+        # Only convert what isn't known already
+        missing = [ value for value in values if not pure or (helper, value, options) not in Helpers.memo ]
+        results = {}
+
+        if missing:
+            try:
+                converted = list(Budget.limit(lambda: batch(missing, **modifiers), Budget.helper, f' in helper: {helper}'))
+                assert len(converted) == len(missing), 'expected a result for every value'
+            except TimedOut:
+                raise
+            except Exception as e:
+                error(f'{e!r} ---- helper: {helper}')
+                return [ Helpers.call(helper, value, modifiers) for value in values ]
+
+            results = dict(zip(missing, converted))
+
+            if pure:
+                for value, result in results.items():
+                    Helpers.memo[(helper, value, options)] = result
+
+        return [ results[value] if value in results else Helpers.memo[(helper, value, options)] for value in values ]
+
 
     @staticmethod
     def rgb(value, alpha = None):
@@ -359,6 +621,11 @@ class Helpers:
 
         Optionally, pass in opacity to override or add the alpha channel.
         '''
+        color = Palette.find(value)
+
+        if color:
+            return Palette.rgb(color, value, alpha)
+
         # We got an rgb value
         if not value.startswith('#'):
             # Give it back as it is if no overrides are specified
@@ -400,6 +667,11 @@ class Helpers:
 
         Optionally pass in opacity to override or add the alpha channel.
         '''
+        color = Palette.find(value)
+
+        if color:
+            return Palette.hex(color, value, alpha, argb)
+
         if alpha:
             alpha = hex(round(float(alpha) * 255))[2:]
             
@@ -442,17 +714,7 @@ class Helpers:
 
         Environment variables work, as well as ix variables.
         '''
-        path = os.path.expandvars(path)
-        file = Parser.wrap_file(path)
-
-        # If it's not an ix file just read the contents
-        if not file:
-            with open(path) as f:
-                return f.read()
-
-        contents, _ = Parser.expand_ix_vars(file)
-
-        return contents
+        return Includes.resolve(path)
 
 
     @staticmethod
@@ -476,453 +738,3922 @@ class Helpers:
 
 
 
-class File:
+class Palette:
     '''
-    Structured class to keep track of everything about each
-    file that needs parsing. Such as the comment type,
-    the paths, the ix-configuration, and so on.
+    Every color within the config, parsed once when the config is loaded,
+    so the color helpers only have to format numbers instead of parsing
+    the same strings over and over. Colors that only show up within files
+    are parsed the first time they're used.
+
+    Each color is kept as ( red, green, blue, alpha, digits, is_hex ), where
+    alpha is between 0 and 1, or None, and digits is what the color looks
+    like in hex, without the '#' or the alpha. Values that aren't colors,
+    or that the helpers wouldn't read the same way, are kept as None.
     '''
-    def __init__(self, root, name, notation = '#', rules = None) -> None:
-        self.original_path = root + '/' + name
-        self.name = name
-        self.notation = notation
-        self.hash = ''
-        self.rules = rules
+    colors = {}
 
-        # Flags
-        self.has_custom_dir = False
-        self.has_custom_name = False
-        self.has_custom_access = False
+    hexadecimal = re.compile('#([0-9a-fA-F]{6})([0-9a-fA-F]{2})?$')
+    functional = re.compile('(rgba?)\\(([^()]*)\\)$')
 
-        # Config fields
-        self.to = root
-        self.prefix = '#'
-        self.access = ''
 
-        self.fields = {
-            'to': self.__set_to,
-            'out': self.__set_to,
+    @staticmethod
+    def load(values):
+        '''
+        Parse every color within the given values.
 
-            'as': self.__set_as,
-            'name': self.__set_as,
+        Parameters:
+            values (iterable): The values to look through, usually every value in the config
+        '''
+        for value in values:
+            Palette.find(value)
 
-            'prefix': self.__set_prefix,
 
-            'access': self.__set_access
-        }
+    @staticmethod
+    def find(value):
+        '''
+        Get the parsed color of the given value, parsing
+        it if it hasn't been already.
 
+        Returns:
+            tuple: The color, or None if the value isn't one
+        '''
+        if value in Palette.colors:
+            return Palette.colors[value]
 
+        color = Palette.parse(value)
+        Palette.colors[value] = color
 
-    def get_output_path(self) -> str:
-        '''
-        Get the full (directory + filename) path for the current file.
-        Making sure to account for the location, and add an '.ix' extension
-        to the filename if the directory is the same as the original file.
+        return color
 
-        We do not want to overwrite the original file.
 
-        Parameters:
-            self (File): The current file object
+    @staticmethod
+    def parse(value):
         '''
-        extension = ''
+        Turn a hex ( #181b21, #181b2177 ) or functional ( rgb(24, 27, 33),
+        rgba(24, 27, 33, 0.5) ) color into numbers.
 
-        # If no custom directory was defined
-        # and no custom filename was defined
-        # we add '.ix' to the original file name
-        # when saving so we don't overwrite the original
-        if not self.has_custom_dir:
-            if not self.has_custom_name:
-                extension = '.ix'
+        Returns:
+            tuple: The color, or None if the value isn't one
+        '''
+        if not isinstance(value, str):
+            return None
 
-        # If we have a custom directory
-        # we write to that directory, with whatever the current
-        # name is.
-        return self.to + '/' + self.name + extension
+        match = Palette.hexadecimal.match(value)
 
+        if match:
+            digits, alpha = match.groups()
+            r, g, b = ( int(digits[i:i+2], 16) for i in (0, 2, 4) )
 
+            return (r, g, b, int(alpha, 16) / 255 if alpha else None, digits, True)
 
-    def load_field(self, field_tuple):
+        match = Palette.functional.match(value)
+
+        if not match:
+            return None
+
+        kind, arguments = match.groups()
+        parts = [ part.strip() for part in arguments.split(',') ]
+
+        if len(parts) != (4 if kind == 'rgba' else 3):
+            return None
+
+        # Anything that doesn't read back the same
+        # is left to the helpers to deal with
+        if not all(part.isdigit() and str(int(part)) == part for part in parts[:3]):
+            return None
+
+        try:
+            alpha = float(parts[3]) if kind == 'rgba' else None
+        except ValueError:
+            return None
+
+        r, g, b = ( int(part) for part in parts[:3] )
+
+        return (r, g, b, alpha, hex(r)[2:] + hex(g)[2:] + hex(b)[2:], False)
+
+
+    @staticmethod
+    def rgb(color, value, alpha = None):
         '''
-        Parse a given 'ix' configuration field. Usually comes in the following
-        format `out: /path/to/whatever`. Find out what item this configuration
-        field refers to and run the expected actions for said item.
+        Format a parsed color the way the 'rgb' helper does.
+        '''
+        r, g, b, a, _, is_hex = color
+
+        if alpha:
+            return f'rgba({r}, {g}, {b}, {alpha})'
+
+        if not is_hex:
+            return value
+
+        if a is None:
+            return f'rgb({r}, {g}, {b})'
+
+        return f'rgba({r}, {g}, {b}, {round(a, 2)})'
+
+
+    @staticmethod
+    def hex(color, value, alpha = None, argb = None):
+        '''
+        Format a parsed color the way the 'hex' helper does.
+        '''
+        _, _, _, a, digits, is_hex = color
+
+        if alpha:
+            alpha = hex(round(float(alpha) * 255))[2:]
+        elif is_hex:
+            return value
+        else:
+            alpha = hex(round(a * 255))[2:] if a is not None else ''
+
+        if argb:
+            return f'#{alpha}{digits}'
+
+        return f'#{digits}{alpha}'
+
+
+
+class Environment:
+    '''
+    A snapshot of the environment variables, taken once when ix starts,
+    along with everything needed to expand them the same way
+    'os.path.expandvars' would.
+
+    Every variable that gets expanded while a file is being parsed is
+    remembered, so a change to it can cause the file to be processed again.
+    '''
+    variables = dict(os.environ)
+    pattern = re.compile(r'\$(\w+|\{[^}]*\})', re.ASCII)
+
+
+    @staticmethod
+    def expand(string):
+        '''
+        Replace every environment variable ( $NAME or ${NAME} ) in the given
+        string with its value. Variables that aren't defined are left as they are.
 
         Parameters:
-            self (File): The current file object
-            field (str): The field line directly from a file, with the comment stripped
+            string (str): The string to expand
+
+        Returns:
+            str: The expanded string
         '''
-        field, data = field_tuple
+        if '$' not in string:
+            return string
 
-        parse = self.fields.get(field, lambda x: 'No such field: ' + field)
+        used = []
 
-        if isinstance(data, str):
-            parse(data.strip())
-        else:
-            parse(data)
+        def replace(match):
+            name = match.group(1)
 
+            if name.startswith('{'):
+                name = name[1:-1]
 
+            used.append(name)
+            return Environment.variables.get(name, match.group(0))
 
-    def __set_to(self, data):
+        expanded = Environment.pattern.sub(replace, string)
+        Environment.use(used)
+
+        return expanded
+
+
+    @staticmethod
+    def names(string):
         '''
-        Update the directory that the processed file should be saved
-        to once done, making sure to create said directory if it
-        doesn't exist already and to expand any environment variables
-        or 'ix' variables within it.
+        Find the names of every environment variable within a string.
+        '''
+        return tuple(name.strip('{}') for name in Environment.pattern.findall(string))
 
-        This is used to parse a specific field from the ix configuration.
 
-        Parameters:
-            self (File): The current file object
-            data (str): The new output directory
-        '''
-        expanded = os.path.expandvars(data)
-        expanded = self.__unwrap_parse(Parser.expand_ix_vars(expanded, self.prefix))
+    @staticmethod
+    def use(names):
+        '''
+        Remember that the file currently being parsed in
+        this thread used the given environment variables.
+        '''
+        if not names:
+            return
+
+        frames = Includes.frames()
+
+        if frames:
+            frames[-1][2].update(names)
+
+
+    @staticmethod
+    def digests(names):
+        '''
+        Hash the current value of each of the given environment variables,
+        so they can be stored in the lock file without storing the values.
+
+        Returns:
+            dict: The hash of every variable, or None if it isn't defined
+        '''
+        digests = {}
+
+        for name in sorted(names):
+            value = Environment.variables.get(name)
+            digests[name] = None if value is None else hashlib.md5(value.encode()).hexdigest()
+
+        return digests
+
+
+    @staticmethod
+    def changed(digests):
+        '''
+        Check whether any of the given environment variables
+        changed since they were stored in the lock file.
+
+        Parameters:
+            digests (dict): The variables and the hash they had
+        '''
+        return Environment.digests(digests) != digests
+
+
+
+class Includes:
+    '''
+    Keeps track of every file that gets included into another
+    file during a run.
+
+    Each included file is only rendered once per run, no matter how many
+    files include it, and the result is remembered by its path and the hash
+    of its contents. Every file that gets parsed records which files it
+    included (directly or not) so they can be stored as dependencies in
+    the lock file.
+    '''
+    cache = {}
+    digests = {}
+    lock = threading.Lock()
+    local = threading.local()
+
+    # Which thread is rendering each included file,
+    # and which file each thread is waiting on
+    owners = {}
+    waiting = {}
+
+
+    @staticmethod
+    def frames():
+        '''
+        Get the stack of files currently being parsed in this thread,
+        each one paired with the dependencies, the environment variables
+        and the config keys it has collected so far.
+        '''
+        if not hasattr(Includes.local, 'frames'):
+            Includes.local.frames = []
+
+        return Includes.local.frames
+
+
+    @staticmethod
+    def enter(path):
+        '''
+        Mark the start of parsing the given file in the current thread.
+        '''
+        Includes.frames().append((os.path.abspath(path), {}, set(), set()))
+
+
+    @staticmethod
+    def leave():
+        '''
+        Mark the end of parsing the most recent file in the current thread.
+
+        Returns:
+            dict: Every dependency of the file, and the hash it had
+            set: Every environment variable the file used
+            set: Every config key, and helper expression, the file used
+        '''
+        _, dependencies, variables, keys = Includes.frames().pop()
+        return (dependencies, variables, keys)
+
+
+    @staticmethod
+    def reference(key):
+        '''
+        Remember that the file currently being parsed in this
+        thread used the given config key or helper expression.
+        '''
+        frames = Includes.frames()
+
+        if frames:
+            frames[-1][3].add(key)
+
+
+    @staticmethod
+    def digest(path):
+        '''
+        Hash a file once per run, no matter how many times
+        it is asked for.
+
+        Returns:
+            str: The hash of the file, or None if it doesn't exist
+        '''
+        digest = Includes.digests.get(path)
+
+        if digest is None:
+            try:
+                digest = hash_file(path)
+            except OSError:
+                return None
+
+            Includes.digests[path] = digest
+
+        return digest
+
+
+    @staticmethod
+    def changed(dependencies):
+        '''
+        Check whether any of the given dependencies changed
+        since they were stored in the lock file.
+
+        Parameters:
+            dependencies (dict): Paths and the hash they had when they were included
+        '''
+        for path, digest in dependencies.items():
+            if Includes.digest(path) != digest:
+                return True
+
+        return False
+
+
+    @staticmethod
+    def resolve(path):
+        '''
+        Get the parsed contents of a file that's being included
+        into whatever file is currently being parsed, rendering it
+        only if it hasn't been rendered already.
+
+        Parameters:
+            path (str): The path of the file to include
+
+        Returns:
+            str: The contents of the included file
+        '''
+        Budget.check()
+
+        path = os.path.abspath(Environment.expand(path))
+        frames = Includes.frames()
+
+        if any(path == parent for parent, *_ in frames):
+            chain = ' -> '.join([ parent for parent, *_ in frames ] + [ path ])
+            error(f'Include cycle detected, ignoring: {chain}', True)
+            return ''
+
+        digest = Includes.digest(path)
+
+        if digest is None:
+            error(f'Could not find included file: {path}', True)
+            return ''
+
+        contents, dependencies, variables, keys = Includes.once((path, digest))
+
+        # Whoever is including this file depends on it
+        # as well as on everything it includes
+        if frames:
+            _, parent, used, referenced = frames[-1]
+            parent[path] = digest
+            parent.update(dependencies)
+            used.update(variables)
+            referenced.update(keys)
+
+        return contents
+
+
+    @staticmethod
+    def once(key):
+        '''
+        Render the included file with the given path and hash, unless
+        another thread already did or is doing it, in which case wait
+        for that one instead. The lock is only held to look at the
+        cache, so different files get rendered at the same time.
+
+        Parameters:
+            key (tuple): The path of the file and its hash
+
+        Returns:
+            tuple: The contents of the file, its dependencies, the
+            environment variables and the config keys it used
+        '''
+        me = threading.current_thread()
+
+        while True:
+            with Includes.lock:
+                future = Includes.cache.get(key)
+                owner = future is None
+                cycle = not owner and not future.done() and Includes.waits_on(key, me)
+
+                if owner:
+                    future = Includes.cache[key] = Future()
+                    Includes.owners[key] = me
+                elif not cycle:
+                    Includes.waiting[me] = key
+
+            # Whoever is rendering it is waiting on this thread,
+            # the include cycle gets caught when rendering it here
+            if cycle:
+                return Includes.render(key[0])
+
+            if owner:
+                try:
+                    entry = Includes.render(key[0])
+                except BaseException as e:
+                    # Let the next one that needs it try again
+                    with Includes.lock:
+                        del Includes.cache[key]
+                        del Includes.owners[key]
+
+                    future.set_exception(e)
+                    raise
+
+                with Includes.lock:
+                    del Includes.owners[key]
+
+                future.set_result(entry)
+                return entry
+
+            try:
+                return future.result(Budget.remaining())
+            except FutureTimeout:
+                raise TimedOut(f' while waiting for include: {key[0]}')
+            except Exception:
+                # Whoever was rendering it failed or ran out of time
+                continue
+            finally:
+                with Includes.lock:
+                    Includes.waiting.pop(me, None)
+
+
+    @staticmethod
+    def waits_on(key, thread):
+        '''
+        Check whether the thread rendering the given file is, through any
+        number of other threads, waiting on the given thread. Has to be
+        called with the lock held.
+        '''
+        seen = set()
+        owner = Includes.owners.get(key)
+
+        while owner is not None and owner not in seen:
+            if owner is thread:
+                return True
+
+            seen.add(owner)
+            owner = Includes.owners.get(Includes.waiting.get(owner))
+
+        return False
+
+
+    @staticmethod
+    def render(path):
+        '''
+        Render an included file, or just read it if it's not an ix file.
+
+        Returns:
+            tuple: The contents of the file, its dependencies, the
+            environment variables and the config keys it used
+        '''
+        file = Parser.wrap_file(path)
+
+        if not file:
+            with open(path, 'rb') as f:
+                return (decode(f.read()), {}, set(), set())
+
+        contents = file.render()
+
+        if isinstance(contents, list):
+            contents = b''.join(contents)
+
+        return (decode(contents), file.dependencies, file.variables, file.keys)
+
+
+
+class TimedOut(Exception):
+    '''
+    Raised when a file, or a helper within it, takes
+    longer than it's allowed to.
+    '''
+
+
+
+class Budget:
+    '''
+    Limits how long each file, and each helper within a file, can take,
+    as well as how long the whole run can take.
+
+    Anything with a limit runs in a separate daemon thread that gets
+    abandoned once it runs out of time, so a helper stuck on a hung mount
+    can't hold up the rest of the files. Abandoned work is cancelled at
+    the next variable or include it gets to, since threads can't be
+    stopped from the outside.
+    '''
+    file = None
+    helper = None
+    deadline = None
+
+    local = threading.local()
+
+
+    class Token:
+        '''
+        The time limit of a single piece of work, and whether it was
+        given up on. Work started within other work is cancelled
+        along with it.
+        '''
+        __slots__ = ('ends', 'cancelled', 'parent')
+
+        def __init__(self, ends, parent) -> None:
+            self.ends = ends
+            self.cancelled = False
+            self.parent = parent
+
+
+        def expired(self):
+            token = self
+
+            while token:
+                if token.cancelled or time.monotonic() >= token.ends:
+                    return True
+
+                token = token.parent
+
+            return False
+
+
+    @staticmethod
+    def remaining():
+        '''
+        How many seconds the work in the current thread has left,
+        or None if it has no limit.
+        '''
+        token = getattr(Budget.local, 'token', None)
+        ends = [ end for end in (token and token.ends, Budget.deadline) if end ]
+
+        return min(ends) - time.monotonic() if ends else None
+
+
+    @staticmethod
+    def check():
+        '''
+        Stop the work in the current thread if it
+        ran out of time or was given up on.
+        '''
+        token = getattr(Budget.local, 'token', None)
+
+        if token and token.expired():
+            raise TimedOut()
+
+        if Budget.deadline is not None and time.monotonic() >= Budget.deadline:
+            raise TimedOut(', the run is out of time')
+
+
+    @staticmethod
+    def run(function, limit = None, what = ''):
+        '''
+        Run the given function, giving up on it once it takes longer
+        than the given limit, or than whatever is left of the time of
+        the work it's part of.
+
+        Parameters:
+            function (function): What to run, without any arguments
+            limit (float): How many seconds it can take, if limited
+            what (str): What is being run, for when it times out
+
+        Returns:
+            The result of the function
+        '''
+        remaining = Budget.remaining()
+        limits = [ seconds for seconds in (limit, remaining) if seconds is not None ]
+
+        if not limits:
+            return function()
+
+        timeout = min(limits)
+
+        if timeout <= 0:
+            raise TimedOut(what)
+
+        token = Budget.Token(time.monotonic() + timeout, getattr(Budget.local, 'token', None))
+        frames = list(Includes.frames())
+        result = {}
+
+        def target():
+            # Work on the same files as whoever started this
+            Budget.local.token = token
+            Includes.local.frames = frames
+
+            try:
+                result['value'] = function()
+            except BaseException as e:
+                result['error'] = e
+
+        thread = threading.Thread(target = target, daemon = True)
+        thread.start()
+        thread.join(timeout)
+
+        if thread.is_alive():
+            token.cancelled = True
+            raise TimedOut(what)
+
+        if 'error' in result:
+            raise result['error']
+
+        return result['value']
+
+
+    @staticmethod
+    def limit(function, limit = None, what = ''):
+        '''
+        Run the given function in a separate thread only if it has a limit
+        of its own. Otherwise it runs right away, once it's made sure there's
+        still time left, and the work it's part of is what gets given up on.
+
+        Parameters:
+            function (function): What to run, without any arguments
+            limit (float): How many seconds it can take, if limited
+            what (str): What is being run, for when it times out
+
+        Returns:
+            The result of the function
+        '''
+        if limit is None:
+            Budget.check()
+            return function()
+
+        return Budget.run(function, limit, what)
+
+
+
+class Directories:
+    '''
+    Remembers every output directory used during a run. Lots of files
+    tend to share the same 'to' field, so each different one only gets
+    expanded once, and each directory only gets created once, no matter
+    how many threads are saving files to it.
+    '''
+    expanded = {}
+    created = set()
+    lock = threading.Lock()
+    config = None
+
+
+    @staticmethod
+    def expand(data, prefix):
+        '''
+        Expand the environment and ix variables within an
+        output directory, reusing the result if it was already done.
+
+        Parameters:
+            data (str): The directory, as written in the 'to' field
+            prefix (str): The prefix used for including ix variables
+
+        Returns:
+            tuple: (expanded directory, unmatched variables)
+        '''
+        # The same directory can expand differently
+        # for every configuration, like with profiles
+        if Directories.config is not config:
+            Directories.expanded = {}
+            Directories.config = config
+
+        key = (data, prefix)
+        parsed = Directories.expanded.get(key)
+
+        if parsed is None:
+            parsed = Parser.expand_ix_vars(Environment.expand(data), prefix)
+            Directories.expanded[key] = parsed
+
+        return parsed
+
+
+    @staticmethod
+    def create(path, name):
+        '''
+        Make sure the given directory exists, creating it
+        if this is the first time it's needed.
+
+        Parameters:
+            path (str): The directory
+            name (str): The name of the file that needs it
+        '''
+        if path in Directories.created:
+            return
+
+        with Directories.lock:
+            if path in Directories.created:
+                return
+
+            if not os.path.isdir(path):
+                info('{} does not exist, creating it for the following file: {}'.format(path, name), True)
+                os.makedirs(path, exist_ok = True)
+
+            Directories.created.add(path)
+
+
+    @staticmethod
+    def reset():
+        '''
+        Forget everything, for when the configuration changes.
+        '''
+        Directories.expanded.clear()
+        Directories.created.clear()
+
+
+
+class Template:
+    '''
+    The contents of a file split up into plain text and the variables
+    within it, so the file only has to be read and scanned once no matter
+    how many times, or with how many configurations, it gets rendered.
+
+    Everything is done on the raw bytes of the file, whatever encoding it's
+    in. Only the variables themselves get decoded, and only their values
+    get encoded, as UTF-8.
+
+    Parameters:
+        string (bytes/str): The contents to look through for variables
+        prefix (str): The prefix used for including the variables in the given string
+    '''
+    cache = {}
+
+    # Only keep templates around when they're going
+    # to be rendered more than once, like with profiles
+    keep = False
+
+    brackets = re.compile('\\[(.+?)\\]')
+
+
+    def __init__(self, string, prefix) -> None:
+        if isinstance(string, str):
+            string = encode(string)
+
+        pattern = Template.pattern(prefix)
+
+        # Every even piece is plain text
+        # and every odd one is a variable
+        self.pieces = pattern.split(string)
+        self.pieces[1::2] = [ decode(key) for key in self.pieces[1::2] ]
+        self.prefix = prefix
+
+
+
+    @staticmethod
+    def pattern(prefix):
+        '''
+        The expression that finds every variable with the given prefix.
+        '''
+        return re.compile(re.escape(encode(prefix + sequence[0])) + b'(.+?)' + re.escape(encode(sequence[1])))
+
+
+
+    @staticmethod
+    def scan(source, prefix, skip = ()):
+        '''
+        Scan a mapped file for variables without copying any of it. The
+        plain text in between the variables is kept as slices of the
+        mapping, which get written out as they are.
+
+        Parameters:
+            source (mmap): The mapped file
+            prefix (str): The prefix used for including the variables in the file
+            skip (list): The ( start, end ) of every part of the file to leave out
+
+        Returns:
+            Template: The scanned template
+        '''
+        template = Template.__new__(Template)
+        template.prefix = prefix
+        template.pieces = []
+
+        pattern = Template.pattern(prefix)
+        view = memoryview(source)
+        literal = []
+        position = 0
+
+        # Go through everything in between the skipped parts
+        for start, end in list(skip) + [ (len(source), len(source)) ]:
+            for match in pattern.finditer(source, position, start):
+                literal.append(view[position:match.start()])
+                template.pieces += [ literal, decode(match.group(1)) ]
+                literal = []
+                position = match.end()
+
+            literal.append(view[position:start])
+            position = max(position, end)
+
+        template.pieces.append(literal)
+
+        return template
+
+
+    @staticmethod
+    def load(path, prefix):
+        '''
+        Read and scan the given file, or reuse the result
+        if it was already done during this run.
+
+        Parameters:
+            path (str): The path to the file
+            prefix (str): The prefix used for including the variables in the file
+        '''
+        key = (path, prefix)
+        template = Template.cache.get(key)
+
+        if template is None:
+            with open(path, 'rb') as f:
+                template = Template(f.read(), prefix)
+
+            if Template.keep:
+                Template.cache[key] = template
+
+        return template
+
+
+    def render(self):
+        '''
+        Replace every variable with its value from the configuration.
+        Each different variable is only looked up once.
+
+        Returns:
+            contents (bytes): The original content with all the variables replaced
+            unmatched (list): The keys for all the variables that couldn't be matched
+        '''
+        contents, unmatched = self.chunks()
+        return (b''.join(contents), unmatched)
+
+
+
+    def chunks(self):
+        '''
+        Replace every variable with its value from the configuration,
+        without joining everything together.
+
+        Returns:
+            contents (list): The plain text and the values, in order
+            unmatched (list): The keys for all the variables that couldn't be matched
+        '''
+        contents = []
+        values = {}
+        unmatched = {}
+
+        self.prefetch()
+
+        for index, piece in enumerate(self.pieces):
+            if index % 2 == 0:
+                # Scanned templates have a list of slices
+                if isinstance(piece, list):
+                    contents += piece
+                else:
+                    contents.append(piece)
+
+                continue
+
+            if piece not in values:
+                values[piece] = encode(self.evaluate(piece, unmatched))
+
+            contents.append(values[piece])
+
+        return (contents, list(unmatched))
+
+
+    def prefetch(self):
+        '''
+        Run every pure helper that can convert many values at once, for
+        all the values it's used with in this template, so each variable
+        using it only has to pick up the result.
+        '''
+        groups = {}
+
+        for piece in self.pieces[1::2]:
+            key = piece.strip()
+
+            # Secondary variables have to be replaced first
+            if ' ' not in key or '[' in key:
+                continue
+
+            entry = Helpers.find(key.split(' ', 1)[0])
+
+            if not entry or not entry[1] or not entry[2]:
+                continue
+
+            helper, main, modifiers = Parser.get_helper_arguments(key)
+            groups.setdefault((helper, tuple(sorted(modifiers.items()))), set()).add(main)
+
+        for (helper, modifiers), values in groups.items():
+            Helpers.batch(helper, sorted(values), dict(modifiers))
+
+
+
+    def evaluate(self, key, unmatched):
+        '''
+        Find the value of a single variable, starting with any
+        secondary variables within it ( denoted by '[]' ).
+
+        If no value can be found, the variable is left as it is.
+
+        Parameters:
+            key (str): The variable, without the prefix and brackets
+            unmatched (dict): Where to store the keys that couldn't be matched
+        '''
+        Budget.check()
+
+        # Helpers are remembered as they're written,
+        # the keys within them get remembered as well
+        if ' ' in key.strip():
+            Includes.reference(key.strip())
+
+        for secondary in set(Template.brackets.findall(key)):
+            value = Parser.get_config_key(secondary)
+
+            if not value:
+                unmatched[f'[{secondary}]'] = True
+                continue
+
+            key = key.replace(f'[{secondary}]', value)
+
+        value = Parser.get_main_key_value(key)
+
+        if not value:
+            full_key = '{}{}{}{}'.format(self.prefix, sequence[0], key, sequence[1])
+            unmatched[full_key] = True
+            return full_key
+
+        return value
+
+
+
+class File:
+    '''
+    Structured class to keep track of everything about each
+    file that needs parsing. Such as the comment type,
+    the paths, the ix-configuration, and so on.
+    '''
+    __slots__ = (
+        'original_path', 'name', 'notation', 'digest', 'rules',
+        'dependencies', 'variables', 'keys', 'header', 'flags', 'to', 'prefix', 'access',
+        'output_digest', 'priority', 'render_time', 'blob', 'source'
+    )
+
+    # Flags
+    CUSTOM_DIR = 1
+    CUSTOM_NAME = 2
+    CUSTOM_ACCESS = 4
+
+
+    def __init__(self, root, name, notation = '#', rules = None) -> None:
+        # Most files share their directory, notation and
+        # prefix so only keep one copy of each around
+        root = sys.intern(root)
+
+        self.original_path = root + '/' + name
+        self.name = name
+        self.notation = sys.intern(notation)
+        self.digest = None
+        self.rules = rules
+        self.dependencies = None
+        self.variables = None
+        self.keys = None
+        self.header = ()
+        self.flags = 0
+
+        # Config fields
+        self.to = root
+        self.prefix = '#'
+        self.access = ''
+        self.priority = 0
+        self.output_digest = None
+        self.render_time = None
+        self.blob = None
+
+        # The mapped contents of large files,
+        # or False if the file isn't mapped
+        self.source = None
+
+
+
+    def __flag(bit):
+        '''
+        Expose a single bit of the flags as a boolean attribute
+        '''
+        def get(self):
+            return bool(self.flags & bit)
+
+        def set(self, value):
+            self.flags = self.flags | bit if value else self.flags & ~bit
+
+        return property(get, set)
+
+    has_custom_dir = __flag(CUSTOM_DIR)
+    has_custom_name = __flag(CUSTOM_NAME)
+    has_custom_access = __flag(CUSTOM_ACCESS)
+
+    del __flag
+
+
+
+    @property
+    def hash(self):
+        '''
+        The md5 hash of the file contents as a hex string, or an
+        empty string if it hasn't been calculated. Only the raw
+        digest is stored.
+        '''
+        return self.digest.hex() if self.digest else ''
+
+
+    @hash.setter
+    def hash(self, value):
+        self.digest = bytes.fromhex(value) if value else None
+
+
+
+    def get_output_path(self) -> str:
+        '''
+        Get the full (directory + filename) path for the current file.
+        Making sure to account for the location, and add an '.ix' extension
+        to the filename if the directory is the same as the original file.
+
+        We do not want to overwrite the original file.
+
+        Parameters:
+            self (File): The current file object
+        '''
+        extension = ''
+
+        # If no custom directory was defined
+        # and no custom filename was defined
+        # we add '.ix' to the original file name
+        # when saving so we don't overwrite the original
+        if not self.has_custom_dir:
+            if not self.has_custom_name:
+                extension = '.ix'
+
+        # If we have a custom directory
+        # we write to that directory, with whatever the current
+        # name is.
+        return self.to + '/' + self.name + extension
+
+
+
+    def load_field(self, field_tuple):
+        '''
+        Parse a given 'ix' configuration field. Usually comes in the following
+        format `out: /path/to/whatever`. Find out what item this configuration
+        field refers to and run the expected actions for said item.
+
+        Parameters:
+            self (File): The current file object
+            field (str): The field line directly from a file, with the comment stripped
+        '''
+        field, data = field_tuple
+
+        self.header += (field_tuple,)
+        parse = File.fields.get(field)
+
+        if not parse:
+            return
+
+        if isinstance(data, str):
+            parse(self, data.strip())
+        else:
+            parse(self, data)
+
+
+
+    def __set_to(self, data):
+        '''
+        Update the directory that the processed file should be saved
+        to once done, making sure to expand any environment variables
+        or 'ix' variables within it. The directory itself gets created
+        when the file is saved.
+
+        This is used to parse a specific field from the ix configuration.
+
+        Parameters:
+            self (File): The current file object
+            data (str): The new output directory
+        '''
+        expanded = self.__unwrap_parse(Directories.expand(data, self.prefix))
+
+        self.has_custom_dir = True
+        self.to = expanded
+
+
+
+    def __set_as(self, data):
+        '''
+        Update the name that the processed file should have when it
+        gets saved to the file system.
+
+        This is used to parse a specific field from the ix configuration.
+
+        Parameters:
+            self (File): The current file object
+            data (str): The new file name + extension (if any)
+        '''
+        self.has_custom_name = True
+        self.name = self.__unwrap_parse(Parser.expand_ix_vars(data, self.prefix))
+
+
+
+    def __set_prefix(self, data):
+        '''
+        Replace the default prefix for this specific file.
+
+        This is used to parse a specific field from the ix configuration.
+
+        Parameters:
+            self (File): The current file object
+            data (str): The new prefix
+        '''
+        expanded = self.__unwrap_parse(Parser.expand_ix_vars(data, self.prefix))
+        self.prefix = expanded
+
+
+
+    def __set_access(self, data):
+        '''
+        Take in a decimal string of permissions in 'chmod' format
+        and turn them into an octal value instead since that is the
+        only format the python implementation of chmod will accept.
+
+        This is used to parse a specific field from the ix configuration.
+
+        Parameters:
+            self (File): The current file object
+            data (str): The permissions in 'chmod' format
+        '''
+        self.has_custom_access = True
+        # Turn the perms to octal since chmod only accepts that
+        expanded = self.__unwrap_parse(Parser.expand_ix_vars(data, self.prefix))
+        self.access = int(expanded, 8)
+
+
+
+    def __set_priority(self, data):
+        '''
+        Files with a higher priority get processed before everything else,
+        no matter how long they take. Useful for the files that are needed
+        the most right after a run.
+
+        This is used to parse a specific field from the ix configuration.
+
+        Parameters:
+            self (File): The current file object
+            data (str): The priority, as a whole number
+        '''
+        try:
+            self.priority = int(data)
+        except ValueError:
+            warn(f'Invalid priority "{ data }" in { self.original_path }, expected a whole number')
+
+
+
+    def __unwrap_parse(self, parsed):
+        '''
+        Spread the tuple returned from an expansion of ix variables and making
+        sure to display a message if some variables were not found.
+
+        Parameters:
+            self (File): The current instance
+            parsed (tuple): (parsed contents, unmatched variables)
+        '''
+        contents, unmatched = parsed
+
+        if unmatched:
+            count('unmatched', len(unmatched))
+            Log.unmatched(self.original_path, unmatched)
+
+        return contents
+
+
+
+    # Every ix configuration field, and what parses it
+    fields = {
+        'to': __set_to,
+        'out': __set_to,
+
+        'as': __set_as,
+        'name': __set_as,
+
+        'prefix': __set_prefix,
+
+        'access': __set_access,
+
+        'priority': __set_priority
+    }
+
+    names = tuple(fields)
+
+
+
+    def rebind(self):
+        '''
+        Create a copy of this file with all the ix configuration
+        fields loaded again, using whatever configuration is currently
+        active. The contents of the file are not read again.
+
+        Parameters:
+            self (File): The current file object
+        '''
+        root, name = self.original_path.rsplit('/', 1)
+        file = File(root, name, self.notation, self.rules)
+        file.digest = self.digest
+
+        for field in self.header:
+            file.load_field(field)
+
+        return file
+
+
+
+    def to_dict(self):
+        '''
+        Put everything about this file that we want to store in
+        the lock file within a dictionary
+
+        Parameters:
+            self (File): The current file object
+        '''
+        return {
+            'hash': self.hash_contents(),
+            'stat': stat_file(self.original_path),
+            'output': self.get_output_path(),
+            'dependencies': self.dependencies or {},
+            'environment': Environment.digests(self.variables or ()),
+            'output_digest': self.output_digest,
+            'render_time': self.render_time,
+            'blob': self.blob,
+            'keys': sorted(self.keys or ()),
+            'created_at': str(datetime.now())
+        }
+
+
+
+    def hash_contents(self):
+        '''
+        Hash the entire file contents, only once per file.
+
+        The hash is later used to create unique identifiers for different purposes.
+        One of which is to store the hash in the lock file and later compare when
+        checking whether or not a file should be parsed again.
+
+        Parameters:
+            self (File): The current file object
+        '''
+        if self.digest is None:
+            source = self.map()
+
+            if source is not None:
+                self.digest = hashlib.md5(source).digest()
+            else:
+                self.hash = hash_file(self.original_path)
+
+        return self.hash
+
+
+
+    def map(self):
+        '''
+        Get the mapped contents of the file, mapping
+        it if it's large enough and hasn't been already.
+
+        Parameters:
+            self (File): The current file object
+
+        Returns:
+            mmap: The mapped contents, or None if the file isn't mapped
+        '''
+        if self.source is None:
+            self.source = map_file(self.original_path) or False
+
+        return self.source or None
+
+
+
+    def parse(self, contents = None):
+        '''
+        Parse the contents of the file, replacing
+        all variables with their defined values.
+
+        Parameters:
+            self (File): The current file obejct
+            contents (bytes): The contents of the file, if they were already read
+
+        Returns:
+            str: The parsed contents
+        '''
+        processed = self.substitute(contents)
+
+        if isinstance(processed, list):
+            processed = b''.join(processed)
+
+        return decode(processed)
+
+
+
+    def substitute(self, contents = None, skip = None):
+        '''
+        Replace all variables within the raw contents
+        of the file with their defined values.
+
+        Parameters:
+            self (File): The current file obejct
+            contents (bytes): The contents of the file, if they were already read
+            skip (regex): Leave out every part of a mapped file that matches
+
+        Returns:
+            bytes/list: The contents with every variable replaced, or
+            the pieces of them if the file is mapped
+        '''
+        Includes.enter(self.original_path)
+
+        try:
+            source = self.map() if contents is None else None
+
+            if source is not None:
+                spans = [ match.span() for match in skip.finditer(source) ] if skip else []
+                contents = self.__unwrap_parse(Template.scan(source, self.prefix, spans).chunks())
+            elif contents is None:
+                contents = self.__unwrap_parse(Template.load(self.original_path, self.prefix).render())
+            else:
+                contents = self.__unwrap_parse(Template(contents, self.prefix).render())
+        finally:
+            self.dependencies, self.variables, self.keys = Includes.leave()
+
+        return contents
+
+
+
+    def render(self, contents = None):
+        '''
+        Parse the contents of the file and remove every trace
+        of the ix configuration from it, unless the configuration
+        came from a rules file, in which case there's nothing to remove.
+
+        Parameters:
+            self (File): The current file object
+            contents (bytes): The contents of the file, if they were already read
+
+        Returns:
+            bytes/list: The processed contents, ready to be saved, or
+            the pieces of them if the file is mapped
+        '''
+        start = time.perf_counter()
+        regex = None if self.rules else re.compile(encode('^{}.+[\\s\\S]$'.format(self.notation)), re.MULTILINE)
+
+        # The configuration is left out of mapped
+        # files while they're being scanned
+        processed = self.substitute(contents, regex)
+
+        if regex and not isinstance(processed, list):
+            for line in re.findall(regex, processed):
+                processed = processed.replace(line, b'')
+
+        self.render_time = time.perf_counter() - start
+
+        return processed
+
+
+
+    def rank(self):
+        '''
+        Decide when this file should be processed compared to the others.
+        Files with a higher priority go first, then the ones that take the
+        longest, so they don't end up being the only ones left at the end.
+
+        How long a file takes is known from the last time it was rendered,
+        otherwise it's guessed from the size of the file.
+
+        Parameters:
+            self (File): The current file object
+
+        Returns:
+            tuple: The rank of the file, lowest goes first
+        '''
+        entry = lock_file.get(self.original_path) if lock_file else None
+        cost = entry.get('render_time') if entry else None
+
+        if cost is None:
+            try:
+                cost = os.path.getsize(self.original_path) / File.throughput
+            except OSError:
+                cost = 0
+
+        return (-self.priority, -cost)
+
+    # Roughly how many bytes get rendered per second, to guess
+    # how long a file takes when it was never rendered before
+    throughput = 50 * 1024 * 1024
+
+
+
+class Generations:
+    '''
+    Instead of writing processed files directly to where they belong,
+    every run can write them to a new generation directory, laid out
+    like a 'DESTDIR' install. Files that didn't change get hardlinked
+    from the previous generation.
+
+    Every output is a symlink pointing into the 'current' generation
+    so swapping that single symlink activates, or rolls back, every
+    file at once.
+    '''
+    @staticmethod
+    def directory():
+        return os.path.join(lock_path, 'generations')
+
+
+    @staticmethod
+    def path(number):
+        return os.path.join(Generations.directory(), str(number))
+
+
+    @staticmethod
+    def current_link():
+        return os.path.join(lock_path, 'current')
+
+
+    @staticmethod
+    def numbers():
+        '''
+        Get the numbers of every generation that exists, oldest first.
+        '''
+        try:
+            entries = os.listdir(Generations.directory())
+        except FileNotFoundError:
+            return []
+
+        return sorted(int(entry) for entry in entries if entry.isdigit())
+
+
+    @staticmethod
+    def current():
+        '''
+        Get the number of the active generation, if any.
+        '''
+        try:
+            return int(os.path.basename(os.readlink(Generations.current_link())))
+        except (OSError, ValueError):
+            return None
+
+
+    @staticmethod
+    def begin():
+        '''
+        Create a new, empty generation and make sure every file
+        processed from now on gets written to it.
+
+        Returns:
+            int: The number of the new generation
+        '''
+        global output_root
+
+        number = max(Generations.numbers(), default = 0) + 1
+        output_root = Generations.path(number)
+        os.makedirs(output_root)
+
+        info(f'Creating generation {number}')
+
+        return number
+
+
+    @staticmethod
+    def carry(path):
+        '''
+        Hardlink an output from the active generation into the new one.
+
+        Parameters:
+            path (str): Where the output belongs
+
+        Returns:
+            bool: Whether the previous output existed and could be linked
+        '''
+        previous = Generations.current()
+
+        if previous is None:
+            return False
+
+        source = destination(path, Generations.path(previous))
+        target = destination(path)
+
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok = True)
+            os.link(source, target)
+        except OSError:
+            return False
+
+        return True
+
+
+    @staticmethod
+    def complete():
+        '''
+        Carry over the output of every file that's still in the lock file
+        but didn't make it into the new generation, because it failed or
+        ran out of time. Those keep their previous lock entry, so their
+        previous output is what should stay live until the next run.
+        '''
+        for entry in lock_file.values():
+            output = entry.get('output')
+
+            if output and not os.path.lexists(destination(output)):
+                Generations.carry(output)
+
+
+    @staticmethod
+    def activate(number):
+        '''
+        Make the given generation the current one by swapping a single
+        symlink, then make sure every file in it has a symlink in the
+        place it belongs pointing at it.
+
+        Parameters:
+            number (int): The generation to activate
+        '''
+        link = Generations.current_link()
+        temporary = link + '.tmp'
+        previous = Generations.current()
+
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+
+        # Keep a copy of the lock file so the generation
+        # can be rolled back to later
+        shutil.copyfile(os.path.join(lock_path, 'ix.lock'), Generations.path(number) + '.lock')
+
+        os.symlink(Generations.path(number), temporary)
+        os.replace(temporary, link)
+
+        files = Generations.files(number)
+
+        for path in files:
+            Generations.link(os.sep + path, os.path.join(link, path))
+
+        # Files that only existed in the previous generation
+        # would be left pointing at nothing
+        if previous is not None and previous != number:
+            for path in Generations.files(previous) - files:
+                live = os.sep + path
+
+                if os.path.islink(live) and os.readlink(live) == os.path.join(link, path):
+                    os.remove(live)
+
+        success(f'Activated generation {number}', True)
+
+        Generations.prune()
+
+
+    @staticmethod
+    def files(number):
+        '''
+        Get the paths of every file within a generation,
+        relative to the generation itself.
+
+        Parameters:
+            number (int): The generation to look through
+        '''
+        root = Generations.path(number)
+        paths = set()
+
+        for directory, _, names in os.walk(root):
+            for name in names:
+                paths.add(os.path.relpath(os.path.join(directory, name), root))
+
+        return paths
+
+
+    @staticmethod
+    def link(live, target):
+        '''
+        Make sure the given path is a symlink to the given target,
+        replacing whatever file was there atomically.
+
+        Parameters:
+            live (str): Where the output belongs
+            target (str): The path within the current generation
+        '''
+        if os.path.islink(live) and os.readlink(live) == target:
+            return
+
+        if os.path.isdir(live) and not os.path.islink(live):
+            error(f'Could not link {live}, a directory is in the way', True)
+            return
+
+        temporary = live + '.ix-link'
+
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+
+        os.makedirs(os.path.dirname(live), exist_ok = True)
+        os.symlink(target, temporary)
+        os.replace(temporary, live)
+
+
+    @staticmethod
+    def rollback():
+        '''
+        Activate the generation before the current one, along
+        with the lock file it was created with.
+        '''
+        current = Generations.current()
+        older = [ number for number in Generations.numbers() if current is None or number < current ]
+
+        if not older:
+            error('No previous generation to roll back to', True)
+            return
+
+        number = older[-1]
+        shutil.copyfile(Generations.path(number) + '.lock', os.path.join(lock_path, 'ix.lock'))
+        Generations.activate(number)
+
+
+    @staticmethod
+    def prune():
+        '''
+        Remove all but the most recent generations, never
+        removing the active one.
+        '''
+        current = Generations.current()
+        numbers = Generations.numbers()
+
+        for number in numbers[:-generations_kept]:
+            if number == current:
+                continue
+
+            shutil.rmtree(Generations.path(number), ignore_errors = True)
+
+            if os.path.exists(Generations.path(number) + '.lock'):
+                os.remove(Generations.path(number) + '.lock')
+
+
+
+class Store:
+    '''
+    A content addressed store for processed files. Every different
+    output is only written once, under its hash, and then hardlinked
+    ( or reflinked, or copied if neither works ) to every place it
+    should be saved to. Outputs that are the same across files only
+    take up space once, and outputs that didn't change aren't written
+    at all.
+
+    Since outputs are hardlinks, editing one in place edits the stored
+    copy. They're meant to be replaced, like ix itself does.
+    '''
+    @staticmethod
+    def directory():
+        return os.path.join(lock_path, 'store')
+
+
+    @staticmethod
+    def path(digest, access = None):
+        '''
+        Find where an output is stored. Hardlinks share their permissions
+        so outputs with custom permissions are stored separately.
+        '''
+        name = digest if access is None else '{}.{:o}'.format(digest, access)
+        return os.path.join(Store.directory(), digest[:2], name)
+
+
+    @staticmethod
+    def save(data, access = None):
+        '''
+        Add the given data to the store, unless it's already there.
+
+        Parameters:
+            data (bytes): The processed contents
+            access (int): The permissions of the file, if custom
+
+        Returns:
+            str: The path of the stored data
+        '''
+        digest = hashlib.md5(data).hexdigest()
+        path = Store.path(digest, access)
+
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        fd, temporary = tempfile.mkstemp(dir = os.path.dirname(path))
+
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        os.chmod(temporary, access if access is not None else 0o644)
+
+        # Another thread might have stored the same contents
+        # in the meantime, either way the result is the same
+        os.replace(temporary, path)
+        count('bytes_written', len(data))
+
+        return path
+
+
+    @staticmethod
+    def materialize(target, contents, access = None):
+        '''
+        Make sure the given path has the given contents, by linking
+        it to the stored copy of them.
+
+        Parameters:
+            target (str): Where the output should be saved
+            contents (bytes/str): The processed contents
+            access (int): The permissions of the file, if custom
+
+        Returns:
+            str: The hash of the contents
+        '''
+        stored = Store.save(contents if isinstance(contents, bytes) else encode(contents), access)
+        digest = os.path.basename(stored).split('.')[0]
+
+        try:
+            if os.path.samefile(stored, target):
+                return digest
+        except OSError:
+            pass
+
+        temporary = target + '.ix-store'
+
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+
+        try:
+            os.link(stored, temporary)
+        except OSError:
+            # Different file system, or no hardlinks at all
+            Store.clone(stored, temporary)
+
+        os.replace(temporary, target)
+
+        return digest
+
+
+    @staticmethod
+    def clone(source, target):
+        '''
+        Copy a stored file, sharing its blocks with a reflink
+        when the file system supports it.
+        '''
+        try:
+            import fcntl
+
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                # FICLONE
+                fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno())
+
+            shutil.copymode(source, target)
+        except (ImportError, OSError):
+            shutil.copy2(source, target)
+
+
+    @staticmethod
+    def collect():
+        '''
+        Remove every stored output that isn't linked anywhere anymore.
+        '''
+        for directory, _, names in os.walk(Store.directory()):
+            for name in names:
+                path = os.path.join(directory, name)
+
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+
+
+class Bundle:
+    '''
+    Instead of writing every processed file to the file system, write
+    all of them into a single archive, under their full output path and
+    with their permissions, ready to be extracted on another machine
+    with a single command.
+
+    Supports tar archives ( optionally compressed ) and zip archives,
+    depending on the extension.
+    '''
+    archive = None
+    lock = threading.Lock()
+
+
+    @staticmethod
+    def open(path):
+        '''
+        Start a new archive at the given path.
+
+        Parameters:
+            path (str): Where to save the archive
+        '''
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok = True)
+
+        if path.endswith('.zip'):
+            Bundle.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+            return
+
+        modes = { '.tar.gz': 'w:gz', '.tgz': 'w:gz', '.tar.bz2': 'w:bz2', '.tar.xz': 'w:xz' }
+        mode = next((mode for extension, mode in modes.items() if path.endswith(extension)), 'w')
+
+        Bundle.archive = tarfile.open(path, mode)
+
+
+    @staticmethod
+    def add(path, contents, access = None):
+        '''
+        Add a processed file to the archive.
+
+        Parameters:
+            path (str): The full path the file should be extracted to
+            contents (bytes/str): The processed contents
+            access (int): The permissions of the file, if custom
+        '''
+        data = contents if isinstance(contents, bytes) else encode(contents)
+        name = os.path.splitdrive(os.path.abspath(path))[1].lstrip(os.sep)
+        mode = access if access is not None else 0o644
+
+        with Bundle.lock:
+            if isinstance(Bundle.archive, zipfile.ZipFile):
+                entry = zipfile.ZipInfo(name, time.localtime()[:6])
+                entry.external_attr = (0o100000 | mode) << 16
+                entry.compress_type = zipfile.ZIP_DEFLATED
+                Bundle.archive.writestr(entry, data)
+                return
+
+            entry = tarfile.TarInfo(name)
+            entry.size = len(data)
+            entry.mode = mode
+            entry.mtime = int(time.time())
+            Bundle.archive.addfile(entry, io.BytesIO(data))
+
+
+    @staticmethod
+    def close():
+        if Bundle.archive:
+            Bundle.archive.close()
+            Bundle.archive = None
+
+
+
+class Rules:
+    '''
+    Reads the rules file, which lists every file that should be processed
+    instead of looking for the ix header within each one of them.
+
+    A rules file is either a single JSON object, or JSON lines where every
+    line is either a rule ( anything with a 'file' ) or a setting like
+    'root' and 'vars_file'. The 'file' of a rule can be a glob pattern,
+    in which case the rule is used for every file that matches.
+
+    Rules get expanded and checked in parallel and the result is cached,
+    by the hash of the rules file, along with the modification time of every
+    directory the result depends on, so new or removed files still get noticed,
+    and the environment variables the rules use.
+    '''
+    magic = re.compile('[*?[]')
+    kept = 8
+
+
+    @staticmethod
+    def read(path):
+        '''
+        Read the given rules file, or the cached result
+        if it didn't change since the last time.
+
+        Parameters:
+            path (str): The path to the rules file
+
+        Returns:
+            dict: The settings of the rules file, with every expanded rule under 'parse'
+        '''
+        digest = hash_file(path)
+        cached = Rules.load(digest)
+
+        if cached:
+            return cached
+
+        settings, rules = Rules.parse(path)
+        directories = {}
+        complete = True
+
+        with ThreadPoolExecutor(jobs) as executor:
+            expanded = list(executor.map(Rules.expand, rules))
+
+        settings['parse'] = []
+
+        for found, stamps in expanded:
+            if stamps is None:
+                complete = False
+                continue
+
+            settings['parse'].extend(found)
+            directories.update(stamps)
+
+        # The files rules apply to can depend on environment variables
+        names = set(name for rule in rules if isinstance(rule, dict) and isinstance(rule.get('file'), str)
+                         for name in Environment.names(rule['file']))
+
+        # Rules that failed should be reported
+        # every time, so don't remember them
+        if complete and not planning:
+            Rules.save(digest, { 'settings': settings, 'directories': directories, 'environment': Environment.digests(names) })
+
+        return settings
+
+
+    @staticmethod
+    def parse(path):
+        '''
+        Read the settings and the rules out of a rules file. JSON lines
+        get read one line at a time instead of all at once.
+
+        Parameters:
+            path (str): The path to the rules file
+
+        Returns:
+            tuple: The settings and a list of every rule, as they are written
+        '''
+        with open(path) as f:
+            if not path.endswith('.jsonl'):
+                settings = json.load(f)
+                return settings, settings.pop('parse', [])
+
+            settings = {}
+            rules = []
+
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+
+                try:
+                    item = json.loads(line)
+                except ValueError as e:
+                    error('Invalid rule on line {}: {!r}'.format(number, e))
+                    count('failed')
+                    rules.append(None)
+                    continue
+
+                if isinstance(item, dict) and 'file' not in item:
+                    settings.update(item)
+                else:
+                    rules.append(item)
+
+            return settings, rules
+
+
+    @staticmethod
+    def expand(rule):
+        '''
+        Check a single rule and find every file it applies to.
+
+        Parameters:
+            rule (dict): The rule, as it's written in the rules file
+
+        Returns:
+            tuple: A rule for every file, and the modification time of every
+            directory the result depends on, or None if the rule is invalid
+        '''
+        if rule is None:
+            return [], None
+
+        if not isinstance(rule, dict) or not isinstance(rule.get('file'), str) or '/' not in rule['file']:
+            error('Invalid rule: ' + json.dumps(rule))
+            count('failed')
+            return [], None
+
+        pattern = Environment.expand(os.path.expanduser(rule['file']))
+
+        if not Rules.magic.search(pattern):
+            if not os.path.isfile(pattern):
+                error('Could not find file: ' + rule['file'])
+                count('failed')
+                return [], None
+
+            return [ dict(rule, file = pattern) ], Rules.stamps([ os.path.dirname(pattern) ])
+
+        matches = sorted(path for path in glob.glob(pattern, recursive = True) if os.path.isfile(path))
+
+        if not matches:
+            warn('No files match: ' + rule['file'])
+
+        # Any of the directories being matched could get new files
+        base = []
+
+        for part in pattern.split('/'):
+            if Rules.magic.search(part):
+                break
+
+            base.append(part)
+
+        base = '/'.join(base) or '/'
+        directories = [ base ] + [ os.path.dirname(path) for path in matches ]
+
+        if '**' in pattern:
+            directories += [ directory for directory, _, _ in os.walk(base) ]
+
+        return [ dict(rule, file = path) for path in matches ], Rules.stamps(directories)
+
+
+    @staticmethod
+    def stamps(directories):
+        '''
+        Get the modification time of every given directory.
+
+        Parameters:
+            directories (list): The paths to the directories
+
+        Returns:
+            dict: The modification time of each directory, or None if it doesn't exist
+        '''
+        stamps = {}
+
+        for directory in directories:
+            directory = os.path.abspath(directory)
+
+            if directory in stamps:
+                continue
+
+            try:
+                stamps[directory] = os.stat(directory).st_mtime_ns
+            except OSError:
+                stamps[directory] = None
+
+        return stamps
+
+
+    @staticmethod
+    def load(digest):
+        '''
+        Load the cached rules for a rules file with the given hash, if
+        none of the directories, or environment variables, it used changed.
+
+        Parameters:
+            digest (str): The hash of the rules file
+        '''
+        try:
+            with open(os.path.join(lock_path, 'rules', digest + '.json')) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if Rules.stamps(cached['directories']) != cached['directories']:
+            return None
+
+        if 'environment' not in cached or Environment.changed(cached['environment']):
+            return None
+
+        return cached['settings']
+
+
+    @staticmethod
+    def save(digest, cached):
+        '''
+        Cache the expanded rules for a rules file with the given hash,
+        only keeping the few that were used most recently.
+
+        Parameters:
+            digest (str): The hash of the rules file
+            cached (dict): The settings, rules and directories to remember
+        '''
+        directory = os.path.join(lock_path, 'rules')
+
+        try:
+            os.makedirs(directory, exist_ok = True)
+            fd, temporary = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cached, f)
+
+            os.replace(temporary, os.path.join(directory, digest + '.json'))
+
+            saved = sorted(pathlib.Path(directory).glob('*.json'), key = lambda path: path.stat().st_mtime, reverse = True)
+
+            for path in saved[Rules.kept:]:
+                path.unlink()
+        except OSError as e:
+            info(f'Could not cache the rules: {e!r}')
+
+
+
+class Git:
+    '''
+    Reads the index of the git repository the root directory is in,
+    which knows the blob id and the file system details of every tracked
+    file. Files that still match those details are exactly as they are
+    in the index, so they don't have to be read to be hashed or to find
+    out whether they're ix compatible, only the ones that were modified,
+    or aren't tracked at all, do.
+
+    Only the index file itself gets read, git is never run. Outside of a
+    repository, or with an index that can't be read, every file is read
+    the usual way.
+    '''
+    # Every tracked file, as { path: (blob, seconds, nanoseconds, size, inode) }
+    entries = None
+
+    # When the index was last written, files modified at the same
+    # time or after can't be trusted to match it
+    written = None
+
+    # Whether blobs are ix compatible, as { blob: None or [ notation, header ] }
+    sniffed = {}
+
+
+    @staticmethod
+    def find(root):
+        '''
+        Find the repository the given directory is in.
+
+        Parameters:
+            root (str): The directory to start looking from
+
+        Returns:
+            tuple: The working tree and the git directory, or None if there's no repository
+        '''
+        directory = os.path.abspath(root)
+
+        while True:
+            candidate = os.path.join(directory, '.git')
+
+            if os.path.isdir(candidate):
+                return (directory, candidate)
+
+            # Worktrees and submodules point to the real git directory
+            if os.path.isfile(candidate):
+                with open(candidate) as f:
+                    line = f.readline().strip()
+
+                if line.startswith('gitdir:'):
+                    return (directory, os.path.join(directory, line[7:].strip()))
+
+            parent = os.path.dirname(directory)
+
+            if parent == directory:
+                return None
+
+            directory = parent
+
+
+    @staticmethod
+    def load(root):
+        '''
+        Read the index of the repository the given directory is in,
+        along with what's known about the blobs within it.
+
+        Parameters:
+            root (str): The directory that's being processed
+
+        Returns:
+            bool: Whether the index could be read
+        '''
+        try:
+            found = Git.find(root)
+
+            if not found:
+                info('Not within a git repository, reading every file')
+                return False
+
+            worktree, directory = found
+            index = os.path.join(directory, 'index')
+
+            Git.written = os.stat(index).st_mtime_ns
+
+            with open(index, 'rb') as f:
+                Git.entries = Git.parse(f.read(), worktree)
+        except (OSError, ValueError, struct.error) as e:
+            info(f'Could not read the git index, reading every file: {e!r}')
+            Git.entries = None
+            return False
+
+        try:
+            with open(os.path.join(lock_path, 'git.json')) as f:
+                Git.sniffed = json.load(f)
+        except (OSError, ValueError):
+            Git.sniffed = {}
+
+        return True
+
+
+    @staticmethod
+    def parse(data, worktree):
+        '''
+        Parse the contents of a git index file ( versions 2 to 4 ).
+        Files with merge conflicts, or marked to be skipped, are left out.
+
+        Parameters:
+            data (bytes): The contents of the index
+            worktree (str): The directory every path within the index is relative to
+
+        Returns:
+            dict: Every tracked file, by its full path
+        '''
+        signature, version, count = struct.unpack('>4sLL', data[:12])
+
+        if signature != b'DIRC' or version not in (2, 3, 4):
+            raise ValueError(f'unsupported index: {signature!r} version {version}')
+
+        # Only sha1 repositories are supported,
+        # their index ends with a 20 byte checksum
+        if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+            raise ValueError('the index checksum does not match')
+
+        entries = {}
+        position = 12
+        previous = b''
+
+        for _ in range(count):
+            ( _, _, seconds, nanoseconds, _, inode, _, _, _, size, blob, flags
+            ) = struct.unpack('>10L20sH', data[position:position + 62])
+
+            extended = 0
+            offset = position + 62
+
+            if flags & 0x4000:
+                extended, = struct.unpack('>H', data[offset:offset + 2])
+                offset += 2
+
+            if version == 4:
+                # The path is stored as how much to remove from the
+                # end of the previous one and what to add after that
+                byte = data[offset]
+                offset += 1
+                strip = byte & 0x7f
+
+                while byte & 0x80:
+                    byte = data[offset]
+                    offset += 1
+                    strip = ((strip + 1) << 7) | (byte & 0x7f)
+
+                end = data.index(b'\0', offset)
+                path = previous[:len(previous) - strip] + data[offset:end]
+                position = end + 1
+            else:
+                end = data.index(b'\0', offset)
+                path = data[offset:end]
+
+                # Entries are padded with at least one null to a multiple of 8
+                position += (end - position + 8) & ~7
+
+            previous = path
+
+            # Conflicts, skipped files and files only intended to be added
+            if flags & 0x3000 or extended & 0x6000:
+                continue
+
+            full = os.path.join(worktree, os.fsdecode(path))
+            entries[full] = (blob.hex(), seconds, nanoseconds, size, inode)
+
+        return entries
+
+
+    @staticmethod
+    def blob(path):
+        '''
+        Get the blob id of the given file, but only if the file
+        wasn't modified since it was added to the index.
+
+        Parameters:
+            path (str): The path to the file
+
+        Returns:
+            str: The blob id, or None if the file isn't tracked or was modified
+        '''
+        if not Git.entries:
+            return None
+
+        entry = Git.entries.get(os.path.abspath(path))
+
+        if not entry:
+            return None
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        if stat.st_mtime_ns >= Git.written:
+            return None
+
+        seconds, nanoseconds = divmod(stat.st_mtime_ns, 1000000000)
+        current = (seconds & 0xffffffff, nanoseconds, stat.st_size & 0xffffffff, stat.st_ino & 0xffffffff)
+
+        return entry[0] if entry[1:] == current else None
+
+
+    @staticmethod
+    def remember(blob, file):
+        '''
+        Remember whether the contents of a blob are ix compatible,
+        and the ix configuration within them if they are.
+
+        Parameters:
+            blob (str): The blob id
+            file (File): The wrapped file, or None if it's not ix compatible
+        '''
+        Git.sniffed[blob] = [ file.notation, [ list(field) for field in file.header ] ] if file else None
+
+
+    @staticmethod
+    def save():
+        '''
+        Save what's known about the blobs that are still in the index.
+        '''
+        blobs = set(entry[0] for entry in Git.entries.values())
+        sniffed = { blob: header for blob, header in Git.sniffed.items() if blob in blobs }
+
+        try:
+            os.makedirs(lock_path, exist_ok = True)
+            fd, temporary = tempfile.mkstemp(dir = lock_path, suffix = '.tmp')
+
+            with os.fdopen(fd, 'w') as f:
+                json.dump(sniffed, f)
+
+            os.replace(temporary, os.path.join(lock_path, 'git.json'))
+        except OSError as e:
+            info(f'Could not save what is known about the git index: {e!r}')
+
+
+
+class Index:
+    '''
+    Keeps track of every file that uses each config key, and each helper
+    expression, so finding out what a change to the config affects
+    doesn't need a run. It's kept next to the lock file and updated as
+    files get saved or removed.
+
+    The index is split up into shards by the hash of the key, so a lookup
+    only ever reads one small file, no matter how many files there are,
+    and a run only rewrites the shards that changed.
+    '''
+    directory = None
+    shards = {}
+    changed = set()
+
+
+    @staticmethod
+    def open(directory):
+        '''
+        Start using the index that belongs to the lock file in the given directory.
+        '''
+        Index.directory = os.path.join(directory, 'index')
+        Index.shards = {}
+        Index.changed = set()
+
+
+    @staticmethod
+    def normalize(key):
+        '''
+        Write a key the same way the config does, helper
+        expressions are kept the way they're written.
+        '''
+        key = key.strip()
+
+        if ' ' in key or '.' not in key:
+            return key
+
+        section, name = key.split('.', 1)
+        return section + '.' + name.lower()
+
+
+    @staticmethod
+    def shard(key):
+        '''
+        Get the shard the given key belongs to, reading it if needed.
+
+        Returns:
+            tuple: The name of the shard and its contents
+        '''
+        name = hashlib.md5(key.encode()).hexdigest()[:2]
+
+        if name not in Index.shards:
+            try:
+                with open(os.path.join(Index.directory, name + '.json')) as f:
+                    Index.shards[name] = json.load(f)
+            except (OSError, ValueError):
+                Index.shards[name] = {}
+
+        return (name, Index.shards[name])
+
+
+    @staticmethod
+    def update(source, output, before, after):
+        '''
+        Move a file from the keys it used before to the ones it uses now.
+
+        Parameters:
+            source (str): The path of the file
+            output (str): Where the file is saved to
+            before (iterable): The keys the file used the last time it was saved
+            after (iterable): The keys the file uses now
+        '''
+        for key in set(before).difference(after):
+            name, shard = Index.shard(key)
+            files = shard.get(key, {})
+
+            if files.pop(source, None) is not None:
+                Index.changed.add(name)
+
+            if not files:
+                shard.pop(key, None)
+
+        for key in after:
+            name, shard = Index.shard(key)
+            files = shard.setdefault(key, {})
+
+            if files.get(source) != output:
+                files[source] = output
+                Index.changed.add(name)
+
+
+    @staticmethod
+    def where(key):
+        '''
+        Find every file that uses the given key or helper expression.
+
+        Returns:
+            dict: The path of every file, and where it's saved to
+        '''
+        _, shard = Index.shard(Index.normalize(key))
+        return shard.get(Index.normalize(key), {})
+
+
+    @staticmethod
+    def close():
+        '''
+        Save the index and stop updating it.
+        '''
+        Index.save()
+        Index.directory = None
+
+
+    @staticmethod
+    def save():
+        '''
+        Save every shard that changed.
+        '''
+        if not Index.changed:
+            return
+
+        os.makedirs(Index.directory, exist_ok = True)
+
+        for name in Index.changed:
+            fd, temporary = tempfile.mkstemp(dir = Index.directory, suffix = '.tmp')
+
+            with os.fdopen(fd, 'w') as f:
+                json.dump(Index.shards[name], f)
+
+            os.replace(temporary, os.path.join(Index.directory, name + '.json'))
+
+        Index.changed = set()
+
+
+
+class Pipeline:
+    '''
+    A chain of steps that every file goes through, with each step running
+    in its own thread(s) and handing files over to the next one through a
+    bounded queue. Files start being saved as soon as the first ones are
+    found, and only a limited number of them are kept in memory at once.
+
+    Parameters:
+        size (int): How many items can wait in between two steps
+    '''
+    done = object()
+
+
+    def __init__(self, size = 64) -> None:
+        self.size = size
+        self.threads = []
+        self.queue = None
+
+
+    def start(self, target):
+        thread = threading.Thread(target = target, daemon = True)
+        self.threads.append(thread)
+        thread.start()
+
+
+    def source(self, items):
+        '''
+        Feed the given items into the first step.
+
+        Parameters:
+            items (iterable): Anything to iterate, a generator works best
+        '''
+        outbound = queue.Queue(self.size)
+
+        def feed():
+            try:
+                for item in items:
+                    outbound.put(item)
+            except Exception as e:
+                error(f'{e!r} ---- while looking for files', True)
+            finally:
+                outbound.put(Pipeline.done)
+
+        self.queue = outbound
+        self.start(feed)
+
+        return self
+
+
+    def stage(self, function, workers = 1, order = None):
+        '''
+        Add a step to the chain. Everything the given function returns
+        gets handed over to the next step, unless it's None.
+
+        When an order is given, the next step always takes the lowest
+        ranked item out of everything that's waiting, instead of the
+        oldest one. Just as many items can wait as without an order, so
+        the ranking applies within that window and memory stays bounded.
+
+        Parameters:
+            function (function): What to run for each item
+            workers (int): How many threads should run the step
+            order (function): Ranks the items handed over to the next step
+        '''
+        inbound = self.queue
+        outbound = Pipeline.Ordered(order, self.size) if order else queue.Queue(self.size)
+        remaining = [ workers ]
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                item = inbound.get()
+
+                if item is Pipeline.done:
+                    # Let the other workers know as well
+                    inbound.put(item)
+
+                    with lock:
+                        remaining[0] -= 1
+
+                        if remaining[0] == 0:
+                            outbound.put(Pipeline.done)
+
+                    return
+
+                try:
+                    result = function(item)
+                except Exception as e:
+                    error(f'{e!r} ---- {getattr(item, "original_path", item)}', True)
+                    count('failed')
+                    continue
+
+                if result is not None:
+                    outbound.put(result)
+
+        for _ in range(workers):
+            self.start(work)
+
+        self.queue = outbound
+
+        return self
+
+
+    def drain(self):
+        '''
+        Go through everything that made it out of the last step.
+
+        Returns:
+            generator: The results of the last step
+        '''
+        while True:
+            item = self.queue.get()
+
+            if item is Pipeline.done:
+                break
+
+            yield item
+
+        for thread in self.threads:
+            thread.join()
+
+
+
+    class Ordered(queue.Queue):
+        '''
+        A queue that always hands out the lowest ranked item first, with
+        items of the same rank in the order they came in. The end of
+        the queue always comes after every item.
+
+        Parameters:
+            key (function): Ranks each item
+            size (int): How many items can wait, without a limit if 0
+        '''
+        def __init__(self, key, size = 0) -> None:
+            self.key = key
+            self.counter = itertools.count()
+            super().__init__(size)
+
+
+        def _init(self, maxsize):
+            self.queue = []
+
+
+        def _qsize(self):
+            return len(self.queue)
+
+
+        def _put(self, item):
+            rank = (float('inf'),) if item is Pipeline.done else self.key(item)
+            heapq.heappush(self.queue, (rank, next(self.counter), item))
+
+
+        def _get(self):
+            return heapq.heappop(self.queue)[2]
+
+
+
+class AsyncPipeline:
+    '''
+    The same steps as the pipeline, driven by asyncio instead of a
+    fixed set of threads per step. Every read and write is handed to
+    a thread pool so many of them are waiting on the file system at
+    once, which matters a lot more than CPU on high latency file
+    systems like NFS. Rendering runs on a separate, smaller pool, and
+    a single thread records every saved file in the lock file.
+
+    Parameters:
+        limit (int): How many files can be in progress at the same time
+    '''
+    def __init__(self, limit) -> None:
+        self.limit = max(1, limit)
+
+
+    def run(self, source, check):
+        '''
+        Process every file from the given source, adding each
+        saved file to the lock file.
+
+        Parameters:
+            source (iterable): The files, or paths to possible files, to process
+            check (function): Decides whether a file needs processing
+        '''
+        asyncio.run(self.process_all(source, check))
+
+
+    async def process_all(self, source, check):
+        loop = asyncio.get_running_loop()
+        items = iter(source)
+        pending = set()
+
+        self.reads = ThreadPoolExecutor(max_workers = self.limit)
+        self.renders = ThreadPoolExecutor(max_workers = os.cpu_count() or 1)
+        self.records = ThreadPoolExecutor(max_workers = 1)
+
+        try:
+            while True:
+                # Walking directories is file system
+                # access as well, don't block on it
+                item = await loop.run_in_executor(self.reads, next, items, None)
+
+                if item is None:
+                    break
+
+                pending.add(asyncio.ensure_future(self.process(item, check)))
+
+                if len(pending) >= self.limit:
+                    _, pending = await asyncio.wait(pending, return_when = FIRST_COMPLETED)
+
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            self.reads.shutdown()
+            self.renders.shutdown()
+            self.records.shutdown()
+
+
+    async def process(self, item, check):
+        loop = asyncio.get_running_loop()
+        path = getattr(item, 'original_path', item)
+
+        try:
+            file = await loop.run_in_executor(self.reads, Parser.sniff, item)
+            if not file: return
+
+            file = await loop.run_in_executor(self.reads, check, file)
+            if not file: return
+
+            contents = None
+
+            # Profiles keep the templates around
+            # after reading them the first time
+            if not Template.keep and not file.source:
+                contents = await loop.run_in_executor(self.reads, read_file, file.original_path)
+
+            processed = await loop.run_in_executor(self.renders, Parser.render, file, contents)
+            if processed is None: return
+
+            if await loop.run_in_executor(self.reads, Parser.save_file, file, processed):
+                # Only the recorder thread touches the lock file,
+                # hashing and index updates don't block the loop
+                await loop.run_in_executor(self.records, Parser.record_file, file)
+        except Exception as e:
+            error(f'{e!r} ---- {path}', True)
+            count('failed')
+
+
+
+class Log:
+    '''
+    Collects every message instead of printing it right away. Each thread
+    gets its own buffer to write to, so workers never wait on each other
+    or on the terminal, and a single writer thread empties all of them
+    every so often in one write, in the order things happened.
+
+    Warnings about missing variables are gathered up for the whole run
+    and shown once per variable at the end, no matter how many files
+    it was missing from.
+    '''
+    format = 'text'
+    interval = 0.05
+    stream = None
+
+    # Every thread that logged something, with its buffer
+    buffers = []
+    missing = []
+    local = threading.local()
+    lock = threading.Lock()
+    flushing = threading.Lock()
+    writer = None
+    stopped = threading.Event()
+
+    # How many files to name when a variable is missing from a lot of them
+    shown = 5
+
+    symbols = {
+        'info': CYAN + 'ℹ ' + WHITE,
+        'error': RED + '✖ ',
+        'warn': YELLOW + '⚠ ' + WHITE,
+        'success': GREEN + '✔ ' + WHITE,
+        'log': MAGENTA + '~ ' + WHITE
+    }
+
+    colors = re.compile(r'\x1B\[[0-9;]*m')
+
+
+    @staticmethod
+    def buffer(name):
+        '''
+        Get the buffer of the current thread, making one if it's the
+        first time the thread logs anything.
+
+        Parameters:
+            name (str): Which buffer, 'messages' or 'missing'
+        '''
+        found = getattr(Log.local, name, None)
+
+        if found is None:
+            found = collections.deque()
+            setattr(Log.local, name, found)
+
+            with Log.lock:
+                (Log.buffers if name == 'messages' else Log.missing).append((threading.current_thread(), found))
+
+                if name == 'messages' and Log.writer is None:
+                    Log.stopped.clear()
+                    Log.writer = threading.Thread(target = Log.loop, daemon = True)
+                    Log.writer.start()
+
+        return found
+
+
+    @staticmethod
+    def write(level, message, **fields):
+        '''
+        Queue a message up for the writer.
+
+        Parameters:
+            level (str): One of info, error, warn, success, log
+            message (str): What to show
+            fields (dict): Anything extra to add to the JSON lines
+        '''
+        Log.buffer('messages').append((time.time(), level, message, fields))
+
+
+    @staticmethod
+    def unmatched(path, variables):
+        '''
+        Remember the variables that could not be found in a file,
+        to show them all together once the run is done.
+
+        Parameters:
+            path (str): The file the variables were used in
+            variables (list): Every variable that was not found
+        '''
+        Log.buffer('missing').append((path, variables))
+
+
+    @staticmethod
+    def render(entry):
+        '''
+        Turn a queued message into the line that gets written out.
+        '''
+        when, level, message, fields = entry
+
+        if Log.format == 'json':
+            return json.dumps({
+                'time': round(when, 3),
+                'level': level,
+                'message': Log.colors.sub('', message),
+                **fields
+            })
+
+        return Log.symbols[level] + message + RESET
+
+
+    @staticmethod
+    def loop():
+        while not Log.stopped.wait(Log.interval):
+            Log.flush()
+
+
+    @staticmethod
+    def flush():
+        '''
+        Write out everything that every thread has queued up so far.
+        Buffers of threads that are done and have nothing left in them
+        are forgotten about.
+        '''
+        with Log.flushing:
+            with Log.lock:
+                buffers = list(Log.buffers)
+
+            entries = []
+
+            for _, buffer in buffers:
+                while buffer:
+                    entries.append(buffer.popleft())
+
+            with Log.lock:
+                Log.buffers = [(t, b) for t, b in Log.buffers if b or t.is_alive()]
+
+            if not entries:
+                return
+
+            # Each buffer is in order on its own, put them together
+            entries.sort(key = lambda entry: entry[0])
+            stream = Log.stream or (sys.stderr if planning else sys.stdout)
+
+            stream.write('\n'.join(Log.render(entry) for entry in entries) + '\n')
+            stream.flush()
+
+
+    @staticmethod
+    def summary():
+        '''
+        Show a single warning for every variable that was missing
+        from at least one file, with the files it was missing from.
+        '''
+        with Log.lock:
+            missing = list(Log.missing)
+
+        files = {}
+
+        for _, buffer in missing:
+            while buffer:
+                path, variables = buffer.popleft()
+
+                for variable in variables:
+                    files.setdefault(variable, set()).add(str(path))
+
+        with Log.lock:
+            Log.missing = [(t, b) for t, b in Log.missing if b or t.is_alive()]
+
+        for variable in sorted(files):
+            paths = sorted(files[variable])
+            listed = '\n\t'.join(paths[:Log.shown])
+            rest = len(paths) - Log.shown
+            more = f'\n\t...and { rest } more' if rest > 0 else ''
+            where = '1 file' if len(paths) == 1 else f'{ len(paths) } files'
+
+            Log.write(
+                'warn',
+                f'Could not find { variable } in { where }\n\t{ listed }{ more }\n',
+                variable = variable,
+                files = paths
+            )
+
+
+    @staticmethod
+    def close():
+        '''
+        Stop the writer and write out whatever is left, along with
+        the warnings that were gathered up during the run.
+        '''
+        Log.summary()
+
+        with Log.lock:
+            writer, Log.writer = Log.writer, None
+
+        if writer is not None:
+            Log.stopped.set()
+            writer.join()
+
+        Log.flush()
+
+
+
+#    __                  _   _
+#   / _|_   _ _ __   ___| |_(_) ___  _ __  ___
+#  | |_| | | | '_ \ / __| __| |/ _ \| '_ \/ __|
+#  |  _| |_| | | | | (__| |_| | (_) | | | \__ \
+#  |_|  \__,_|_| |_|\___|\__|_|\___/|_| |_|___/
+# -------------------------------------------------------------------------
+def out(level, message, forced = False):
+    if forced or verbose:
+        Log.write(level, message)
+
+def info(message, f = False):      out('info', message, f)
+def error(message, f = False):     out('error', message, f)
+def warn(message, f = False):      out('warn', message, f)
+def success(message, f = False):   out('success', message, f)
+def log(message, f = False):       out('log', message, f)
+
+
+
+def count(stat, amount = 1):
+    '''
+    Increment one of the run statistics. Files get processed
+    in multiple threads at once so make sure only one of them
+    touches the counters at a time.
+
+    Parameters:
+        stat (str): The name of the statistic to increment
+        amount (int): How much to increment it by
+    '''
+    with stats_lock:
+        stats[stat] += amount
+
+
+
+def save_metrics(path, duration):
+    '''
+    Write the statistics of the current run to a text file in the
+    prometheus exposition format, ready to be picked up by the
+    node-exporter textfile collector.
+
+    The file gets written to a temporary file in the same directory
+    first and then moved in place so the collector never reads
+    a half written file.
+
+    Parameters:
+        path (str): Where the metrics should be saved
+        duration (float): How long the run took, in seconds
+    '''
+    metrics = [
+        ('ix_run_duration_seconds', 'Time it took to finish the last run', round(duration, 6)),
+        ('ix_last_run_timestamp_seconds', 'When the last run finished', round(time.time(), 3)),
+        ('ix_files_discovered', 'Number of ix compatible files found', stats['discovered']),
+        ('ix_files_rendered', 'Number of files that were processed and saved', stats['rendered']),
+        ('ix_files_unchanged', 'Number of files skipped because they were unchanged', stats['unchanged']),
+        ('ix_files_failed', 'Number of files that could not be processed', stats['failed']),
+        ('ix_files_removed', 'Number of outputs removed because their source was removed or retargeted', stats['removed']),
+        ('ix_unmatched_variables', 'Number of variables that had no value in the config', stats['unmatched']),
+        ('ix_files_timed_out', 'Number of files that ran out of time, or were skipped because the run did', stats['timed_out']),
+        ('ix_lock_entries', 'Number of files stored in the lock file', len(lock_file or {})),
+        ('ix_bytes_written', 'Number of bytes written to processed files', stats['bytes_written'])
+    ]
+
+    lines = []
+
+    for name, description, value in metrics:
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+
+    directory = os.path.dirname(os.path.abspath(path))
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # The collector only reads files ending in '.prom'
+    # so the temporary one will be ignored until it's moved
+    fd, temporary = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    os.chmod(temporary, 0o644)
+    os.replace(temporary, path)
+
+
+
+def destination(path, root = None):
+    '''
+    Find out where a processed file should actually be written.
+    When an output root is active ( like with profiles ) every file
+    gets written under it, keeping its full original path, similar
+    to a 'DESTDIR' install.
+
+    Parameters:
+        path (str): The path the file would normally be saved to
+        root (str): The output root to use instead of the active one
+    '''
+    root = root or output_root
+
+    if not root:
+        return path
+
+    _, absolute = os.path.splitdrive(os.path.abspath(path))
+
+    return os.path.join(root, absolute.lstrip(os.sep))
+
+
+
+def get_file_lines(file_path, source = None):
+    '''
+    Try and open a file as a text file, in whatever encoding.
+    If succeeded, return an array of all the lines
+    inside that file.
+
+    Lines of mapped files are only read as they're needed.
+    '''
+    if source:
+        if b'\0' in source[:8192]:
+            info('Found non-text file, ignoring: ' + file_path)
+            return None
+
+        return (decode(line) for line in iter(source.readline, b''))
+
+    try:
+        with open(file_path, 'rb') as file:
+            data = file.read()
+    except PermissionError:
+        info('No permission to access file, ignoring: ' + file_path)
+        Parser.unreadable.add(file_path)
+        return None
+    except OSError:
+        info('Could not read file, ignoring: ' + file_path)
+        Parser.unreadable.add(file_path)
+        return None
+
+    # Text files don't have null bytes, whatever
+    # their encoding ( UTF-16 and such aside )
+    if b'\0' in data[:8192]:
+        info('Found non-text file, ignoring: ' + file_path)
+        return None
+
+    return decode(data).split('\n')
+
+
+
+def read_file(path):
+    '''
+    Read the entire contents of a file, as they are.
+
+    Parameters:
+        path (str): The path to the file
+    '''
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+
+def stat_file(path):
+    '''
+    Get what's needed to tell whether a file changed without reading it.
+
+    Parameters:
+        path (str): The path to the file
+
+    Returns:
+        list: When the file was modified, in nanoseconds, and its size, or None if it doesn't exist
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return [ stat.st_mtime_ns, stat.st_size ]
+
+
+
+def map_file(path):
+    '''
+    Map a large file into memory instead of reading it, so every
+    step that needs its contents can use it without copying it.
+    Smaller files are faster to simply read.
+
+    Parameters:
+        path (str): The path to the file
+
+    Returns:
+        mmap: The mapped file, or None if it's too small or can't be mapped
+    '''
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < map_threshold:
+                return None
+
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+
+
+def encode(string):
+    '''
+    Turn text back into bytes. Anything that was decoded from
+    bytes that aren't valid UTF-8 turns back into the same bytes.
+    '''
+    return string.encode('utf-8', 'surrogateescape')
+
+
+
+def decode(data):
+    '''
+    Turn bytes into text without failing on bytes
+    that aren't valid UTF-8, so they can be turned back.
+    '''
+    return data.decode('utf-8', 'surrogateescape')
+
+
+
+def hash_file(path):
+    '''
+    Hash the entire contents of a file, not all at once of course,
+    do it in chunks in case we hit some massive files we don't want to
+    eat up all the RAM.
+
+    The hashing is done in md5 since it's fast and we really don't have to
+    worry about colisions. The chances of the same file colliding are extremely
+    small.
+
+    Parameters:
+        path (str): The path to the file to hash
+    '''
+    md5 = hashlib.md5()
+
+    with open(path, 'rb') as bytes:
+        while True:
+            data = bytes.read(65536)
+
+            if not data:
+                break
+
+            md5.update(data)
+
+    return md5.hexdigest()
+
+
+
+def read_config(at):
+    '''
+    Read the 'ix' configuration from it's specific path.
+    Either user defined, or the default one. Use config parser
+    to load and resolve all the magic that the .ini format provides.
+
+    Multiple paths can be given as layers, where every layer overrides
+    the values of the ones before it. Each layer is cached in the lock
+    directory, along with when it was modified, so only the layers that
+    changed have to be parsed again. The resolved values are cached too,
+    for as long as none of the layers or environment variables they use change.
+    Nothing gets written until the run is done, see save_config_cache.
+
+    Parameters:
+        at (str/list): The exact path to the config file, or a list of them
+    '''
+    global config_cache
+
+    layers = [ at ] if isinstance(at, (str, os.PathLike)) else list(at)
+    cache = config_cache or read_config_cache()
+    changed = False
+
+    stamps = []
+    merged = {}
+    origin = {}
+
+    for layer in layers:
+        path = os.path.abspath(os.path.expandvars(layer))
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+
+        stamp = [ stat.st_mtime_ns, stat.st_size ]
+        cached = cache['layers'].get(path)
+
+        if not cached or cached['stamp'] != stamp:
+            cached = { 'stamp': stamp, 'sections': read_config_layer(path) }
+            cache['layers'][path] = cached
+            changed = True
+
+        stamps.append([ path ] + stamp)
+
+        for section, values in cached['sections'].items():
+            merged.setdefault(section, {}).update(values)
+
+            for key in values:
+                origin[f'{section}.{key}'] = path
+
+    # Values are stored raw, only interpolate them when read
+    config = configparser.ConfigParser(interpolation = None)
+    config.read_dict(merged)
+    config._interpolation = configparser.ExtendedInterpolation()
+    config.origin = origin
+
+    snapshot = cache.get('resolved')
+
+    if snapshot and snapshot['stamps'] == stamps and not Environment.changed(snapshot['environment']):
+        config.resolved = snapshot['values']
+        config.environment = { key: tuple(names) for key, names in snapshot['variables'].items() }
+    else:
+        # Resolve every value right away, including environment variables,
+        # instead of every time the value is used
+        config.resolved = {}
+        config.environment = {}
+
+        for section in [ config.default_section ] + config.sections():
+            for key in config[section]:
+                try:
+                    value = config[section][key]
+                except Exception:
+                    continue
+
+                config.resolved[f'{section}.{key}'] = Environment.expand(value)
+                config.environment[f'{section}.{key}'] = Environment.names(value)
+
+        names = set(name for used in config.environment.values() for name in used)
+
+        cache['resolved'] = {
+            'stamps': stamps,
+            'values': config.resolved,
+            'variables': config.environment,
+            'environment': Environment.digests(names)
+        }
+        changed = True
+
+    # Only saved once the run is done
+    if changed:
+        config_cache = cache
+
+    Palette.load(config.resolved.values())
+
+    return config
+
+
+
+def read_config_layer(path):
+    '''
+    Parse a single layer of the configuration, without
+    resolving anything within it.
+
+    Parameters:
+        path (str): The path to the layer
+
+    Returns:
+        dict: The raw values of every section within the layer
+    '''
+    layer = configparser.RawConfigParser()
+    layer.read(path)
+
+    sections = { section: dict(values) for section, values in layer._sections.items() }
+
+    if layer.defaults():
+        sections[layer.default_section] = dict(layer.defaults())
+
+    return sections
+
+
+
+def read_config_cache():
+    '''
+    Read the cached configuration layers, starting
+    fresh if there's nothing cached or it can't be read.
+    '''
+    try:
+        with open(os.path.join(lock_path, 'config.json')) as f:
+            cache = json.load(f)
+
+        if 'layers' in cache:
+            return cache
+    except (OSError, ValueError):
+        pass
+
+    return { 'layers': {} }
+
+
+
+def save_config_cache():
+    '''
+    Save the configuration layers cached during the run, if any of them
+    changed, and only once the run is done so merely loading ix, or making
+    a plan, doesn't write anything. The cache is only there to save time,
+    so it's fine if it can't be saved.
+    '''
+    global config_cache
+
+    if config_cache is None or planning:
+        return
+
+    try:
+        os.makedirs(lock_path, exist_ok = True)
+        fd, temporary = tempfile.mkstemp(dir = lock_path, suffix = '.tmp')
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(config_cache, f)
+
+        os.replace(temporary, os.path.join(lock_path, 'config.json'))
+        config_cache = None
+    except OSError as e:
+        info(f'Could not cache the configuration: {e!r}')
+
+
+
+def read_lock_file(path, name = 'ix.lock'):
+    '''
+    Read a JSON file into a dictionary allowing us to do
+    quick lookups for specific files whenever we need to check
+    if one was already parsed or not, allowing us to skip part of the
+    process.
+
+    Parameters:
+        path (str): The directory of the lock file
+        name (str): The name of the lock file
+    '''
+    try:
+        file = open(path + '/' + name)
+        contents = json.loads(file.read())
+        file.close()
+        return contents
+    except FileNotFoundError:
+        # Start fresh if the file doesn't exist
+        return {}
+
+
+
+def save_lock_file(path, data, name = 'ix.lock'):
+    '''
+    Save a dictionary full of all parsed files to a file.
+    This will be used later on when 'ix' runs again in order
+    to check which files have changed and only re-process those files.
+
+    Giving a bit of a performance boost in very large directories.
+
+    Parameters:
+        path (str): The directory of the lock file
+        data (dict): Dictionary full of all the file data that we care about saving
+        name (str): The name of the lock file
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    with open(path + '/' + name, 'w') as lock:
+        lock.write(json.dumps(data))
+
+
+
+def in_shard(path):
+    '''
+    Find out whether the given file belongs to the shard being
+    processed. Files are split up by the hash of their path relative
+    to the root directory, so every machine splits them up the same way.
+
+    Parameters:
+        path (str): The path to the source file
+    '''
+    if not shard:
+        return True
+
+    index, total = shard
+    relative = os.path.relpath(path, root_path)
+    digest = hashlib.md5(relative.encode()).hexdigest()
+
+    return int(digest[:8], 16) % total == index - 1
+
+
+
+def merge_locks(locks):
+    '''
+    Combine multiple lock files, like the ones created by each shard,
+    into a single one. If the same file shows up in more than one of
+    them, the most recently processed one wins.
+
+    Parameters:
+        locks (list): The lock file contents to merge
+
+    Returns:
+        dict: The merged lock file contents
+    '''
+    merged = {}
+
+    # Times without microseconds leave them out completely,
+    # so they can't be compared as they're written
+    def created(entry):
+        try:
+            return datetime.fromisoformat(entry.get('created_at', ''))
+        except ValueError:
+            return datetime.min
+
+    for lock in locks:
+        for source, entry in lock.items():
+            previous = merged.get(source)
+
+            if previous and created(previous) > created(entry):
+                continue
+
+            merged[source] = entry
+
+    return merged
+
+
+
+def remove_outputs(paths):
+    '''
+    Remove a list of previously processed files from the file system,
+    all at once since the removals don't depend on each other.
+
+    Parameters:
+        paths (list): The paths of the files to remove
+    '''
+    def remove(path):
+        try:
+            os.remove(path)
+            log(f'\tRemoved: {path}')
+            count('removed')
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            error(f"Couldn't remove: {path} - {e!r}")
+
+    if not paths:
+        return
+
+    with ThreadPoolExecutor(max_workers = min(32, len(paths))) as executor:
+        list(executor.map(remove, paths))
+
+
+
+def cleanup():
+    '''
+    Attempt to remove all the files that were previously
+    processed and stored in the cache, making sure to 
+    clear the cache when done so we're starting fresh.
+
+    When profiles are defined, the files of every profile get removed.
+    '''
+    namespaces = [ (lock_path, output_root) ]
+
+    if profiles:
+        namespaces = [ (os.path.join(lock_path, 'profiles', name), os.path.expandvars(output)) for name, _, output in profiles ]
+
+    info('Purging all previous builds...', True)
+
+    for directory, root in namespaces:
+        lock = read_lock_file(directory)
+
+        if lock == {}:
+            log('Found no items in cache: {}'.format(directory), True)
+            continue
+
+        remove_outputs([ destination(entry['output'], root) for entry in lock.values() ])
+        save_lock_file(directory, {})
+
+    success('Done', True)
+
+
+
+def stale(outputs, previous = None):
+    '''
+    Find every file in the lock file that doesn't get processed
+    anymore, either because it was deleted, because it's within the
+    parsed directory and was read but no longer ix compatible, or
+    because it now saves to a different location. Files that couldn't
+    be read this time are left alone.
+
+    Parameters:
+        outputs (dict): The output path of every file found in the current run
+        previous (dict): The output every file in the lock file had before
+        the run, taken from the lock file as it is now if not given
+
+    Returns:
+        list: Every ( source, output ) that's stale, the output being None
+        if something else is saving to the same place now
+    '''
+    if previous is None:
+        previous = { source: entry['output'] for source, entry in lock_file.items() }
+
+    current = outputs
+    outputs = set(current.values())
+    root = os.path.abspath(root_path) + os.sep
 
-        # If the given directory does not exist
-        # we want to create it.
-        if not os.path.isdir(expanded):
-            info('{} does not exist, creating it for the following file: {}'.format(expanded, self.name), True)
-            os.makedirs(expanded)
+    found = []
 
-        self.has_custom_dir = True
-        self.to = expanded
+    for source, before in previous.items():
+        output = current.get(source)
 
+        # Other shards take care of their own files
+        if not in_shard(source):
+            continue
 
+        if output == before:
+            continue
 
-    def __set_as(self, data):
-        '''
-        Update the name that the processed file should have when it
-        gets saved to the file system.
+        if output is None and os.path.isfile(source):
+            # Files outside the parsed directory, or files from a rules
+            # file, might just not be part of this run
+            if json_rules or not os.path.abspath(source).startswith(root):
+                continue
 
-        This is used to parse a specific field from the ix configuration.
+            # Failing to read a file doesn't mean it's not ix compatible
+            if source in Parser.unreadable:
+                continue
 
-        Parameters:
-            self (File): The current file object
-            data (str): The new file name + extension (if any)
-        '''
-        self.has_custom_name = True
-        self.name = self.__unwrap_parse(Parser.expand_ix_vars(data, self.prefix))
+        found.append((source, before if before not in outputs else None))
 
+    return found
 
 
-    def __set_prefix(self, data):
-        '''
-        Replace the default prefix for this specific file.
 
-        This is used to parse a specific field from the ix configuration.
+def prune(outputs, previous = None):
+    '''
+    Compare the files found in the current run with the ones in the
+    lock file, and remove the outputs of everything that doesn't get
+    processed anymore, as well as their entries in the lock file.
 
-        Parameters:
-            self (File): The current file object
-            data (str): The new prefix
-        '''
-        expanded = self.__unwrap_parse(Parser.expand_ix_vars(data, self.prefix))
-        self.prefix = expanded
+    An output is removed when its source file was deleted, when its source
+    file is within the parsed directory and was read but no longer ix
+    compatible, or when its source file now saves to a different location.
 
+    Parameters:
+        outputs (dict): The output path of every file found in the current run
+        previous (dict): The output every file in the lock file had before the run
+    '''
+    orphans = []
 
+    for source, output in stale(outputs, previous):
+        # With generations, the output is only the symlink, the
+        # new generation won't have the file at all
+        if output:
+            orphans.append(output if generations else destination(output))
 
-    def __set_access(self, data):
-        '''
-        Take in a decimal string of permissions in 'chmod' format
-        and turn them into an octal value instead since that is the
-        only format the python implementation of chmod will accept.
+        # Files that were saved to their new location this
+        # run already have the lock entry they should have
+        entry = lock_file.get(source)
 
-        This is used to parse a specific field from the ix configuration.
+        if entry is None or entry['output'] == outputs.get(source):
+            continue
 
-        Parameters:
-            self (File): The current file object
-            data (str): The permissions in 'chmod' format
-        '''
-        self.has_custom_access = True
-        # Turn the perms to octal since chmod only accepts that
-        expanded = self.__unwrap_parse(Parser.expand_ix_vars(data, self.prefix))
-        self.access = int(expanded, 8)
+        del lock_file[source]
 
+        if Index.directory:
+            Index.update(source, None, entry.get('keys', ()), ())
 
+    if orphans:
+        info('Removing {} files that are no longer processed'.format(len(orphans)))
 
-    def __unwrap_parse(self, parsed):
-        '''
-        Spread the tuple returned from an expansion of ix variables and making
-        sure to display a message if some variables were not found.
+    remove_outputs(orphans)
 
-        Parameters:
-            self (File): The current instance
-            parsed (tuple): (parsed contents, unmatched variables)
-        '''
-        contents, unmatched = parsed
 
-        if unmatched:
-            variables = '\n\t'.join(unmatched)
-            warn(f'Could not find\n\t{ variables }\n in { self.original_path }\n', True)
 
-        return contents
+def main(rules = None):
+    '''
+    The main entrypoint for the program.
+    Initializes everything that needs to happen.
+    From finding all the 'ix' files to creating new Threads for
+    parsing each of the available files, as well as saving and updating
+    the lock file once everything has been processed.
 
+    If a metrics file was requested, the statistics of the run get
+    exported once everything is done, even if the run fails. Anything
+    still waiting to be logged is written out at the end as well.
 
+    Args:
+        args (dict): The arguments passed to the program
+    '''
+    started = time.monotonic()
 
-    def to_dict(self):
-        '''
-        Put everything about this file that we want to store in
-        the lock file within a dictionary
+    try:
+        run(rules)
+        save_config_cache()
+    finally:
+        if metrics_path:
+            save_metrics(metrics_path, time.monotonic() - started)
 
-        Parameters:
-            self (File): The current file object
-        '''
-        return {
-            'hash': self.hash_contents(),
-            'output': self.get_output_path(),
-            'created_at': str(datetime.now())
-        }
+        Log.close()
 
 
 
-    def hash_contents(self):
-        '''
-        Hash the entire file contents, not all at once of course,
-        do it in chunks in case we hit some massive files we don't want to
-        eat up all the RAM.
+def run(rules = None):
+    '''
+    Find, process, and cache every file for the current run.
+    When profiles are defined, every file is only found and read once
+    and then processed for each of the profiles.
 
-        The hash is later used to create unique identifiers for different purposes.
-        One of which is to store the hash in the lock file and later compare when
-        checking whether or not a file should be parsed again.
+    When bundling, every file is saved into the bundle instead.
 
-        The hashing is done in md5 since it's fast and we really don't have to
-        worry about colisions. The chances of the same file colliding are extremely
-        small.
+    Parameters:
+        rules (dict): The rules to use instead of the #ix-config headers, if any
+    '''
+    if bundle_path:
+        Bundle.open(bundle_path)
 
-        Parameters:
-            self (File): The current file object
-        '''
-        if self.hash != '':
-            return self.hash
+    if use_git:
+        Git.load(root_path)
 
-        md5 = hashlib.md5()
+    try:
+        process_all(rules)
 
-        with open(self.original_path, 'rb') as bytes:
-            while True:
-                data = bytes.read(65536)
+        if Git.entries is not None:
+            Git.save()
+    finally:
+        if bundle_path:
+            Bundle.close()
+            success('Saved bundle: ' + bundle_path, True)
 
-                if not data:
-                    break
 
-                md5.update(data)
 
-        digest = md5.hexdigest()
-        self.hash = digest
+def process_all(rules = None):
+    '''
+    Process every file for the current run, once, or once per profile.
 
-        return digest
+    Parameters:
+        rules (dict): The rules to use instead of the #ix-config headers, if any
+    '''
+    global config, lock_file, output_root
 
+    if generations:
+        number = Generations.begin()
+        build(discover(rules), lock_path)
+        Generations.complete()
+        Generations.activate(number)
+        return
 
+    if not profiles:
+        build(discover(rules), lock_path)
+        return
 
-    def parse(self):
-        '''
-        Parse the contents of the file, replacing
-        all variables with their defined values.
+    # Every profile needs the same files so they have to be kept around.
+    # Their headers are loaded with the first profile's config, whatever
+    # config was given otherwise, since it's the first one they're used for.
+    config = read_config(profiles[0][1])
+    Parser.unreadable.clear()
+    files = list(Pipeline().source(discover(rules)).stage(Parser.sniff, jobs).drain())
+    unreadable = set(Parser.unreadable)
+    Template.keep = True
 
-        Parameters:
-            self (File): The current file obejct
-        '''
-        with open(self.original_path, 'r') as f:
-            contents = self.__unwrap_parse(Parser.expand_ix_vars(f.read(), self.prefix))
+    # Each file only counts once, no matter how many profiles use it
+    count('discovered', len(files))
 
-        return contents
+    for idx, (name, profile_config, profile_output) in enumerate(profiles):
+        info(f'Processing profile: {name}', True)
+        directory = os.path.join(lock_path, 'profiles', name)
 
+        config = read_config(profile_config)
+        lock_file = read_lock_file(directory)
+        output_root = os.path.expandvars(profile_output)
 
+        # Rendered includes and output directories
+        # depend on the configuration
+        Includes.cache.clear()
+        Directories.reset()
 
-#    __                  _   _
-#   / _|_   _ _ __   ___| |_(_) ___  _ __  ___
-#  | |_| | | | '_ \ / __| __| |/ _ \| '_ \/ __|
-#  |  _| |_| | | | | (__| |_| | (_) | | | \__ \
-#  |_|  \__,_|_| |_|\___|\__|_|\___/|_| |_|___/
-# -------------------------------------------------------------------------
-def out(message, forced = False):
-    if forced or verbose:
-        print(message)
+        # The files were found using the first profile
+        # so there's no need to load their fields again
+        if idx > 0:
+            files = [ file.rebind() for file in files ]
 
-def info(message, f = False):      out(CYAN + 'ℹ ' + WHITE + message + RESET, f)
-def error(message, f = False):     out(RED + '✖ ' + message + RESET, f)
-def warn(message, f = False):      out(YELLOW + '⚠ ' + WHITE + message + RESET, f)
-def success(message, f = False):   out(GREEN + '✔ ' + WHITE + message + RESET, f)
-def log(message, f = False):       out(MAGENTA + '~ ' + WHITE + message + RESET, f)
+        build(files, directory, unreadable, True)
 
 
 
-def get_file_lines(file_path):
+def discover(rules = None):
     '''
-    Try and open a file as a normal text file.
-    If succeeded, return an array of all the lines
-    inside that file.
+    Find all the files that should be processed, either from
+    the given rules, or every file in the root directory, which
+    still have to be checked for the ix header.
+
+    Parameters:
+        rules (dict): The rules to use instead of the #ix-config headers, if any
+
+    Returns:
+        generator: The paths of, or the files that should be processed
     '''
-    try:
-        # Try and open the file as a normal text file
-        # Abort if it's binary or something else
-        file = open(file_path, 'r')
-        lines = list(file)
-        file.close()
+    if not rules:
+        yield from filter(in_shard, Parser.walk(root_path))
+        return
 
-        return lines
-    except PermissionError:
-        info('No permission to access file, ignoring: ' + file_path)
-        return None
-    except:
-        info('Found non-text file, ignoring: ' + file_path)
-        return None
+    # Rules were already expanded and checked
+    # when they were read
+    for f in rules['parse']:
+        if not in_shard(f['file']):
+            continue
 
+        root, name = f['file'].rsplit('/', 1)
+        file = File(root, name, rules = f)
 
+        for field in f.items():
+            file.load_field(field)
 
-def read_config(at):
+        yield file
+
+
+
+def unchanged(file):
     '''
-    Read the 'ix' configuration from it's specific path.
-    Either user defined, or the default one. Use config parser
-    to load and resolve all the magic that the .ini format provides.
+    Check whether a file, and everything it includes, is exactly
+    the same as the last time it was saved, and still saves to the
+    same place. Files with the same size and modification time as
+    back then, or that git knows weren't modified, aren't read again.
 
     Parameters:
-        at (str): The exact path to the config file
+        file (File): The file to check
+
+    Returns:
+        bool: Whether the file can be skipped
     '''
-    config = configparser.ConfigParser()
-    config._interpolation = configparser.ExtendedInterpolation()
-    config.read(at)
+    lock = lock_file.get(file.original_path)
 
-    return config
+    if not lock:
+        return False
+
+    if lock.get('stat') and lock['stat'] == stat_file(file.original_path):
+        file.hash = lock['hash']
+    elif file.blob and file.blob == lock.get('blob'):
+        file.hash = lock['hash']
+
+    return file.hash_contents() == lock['hash'] and lock['output'] == file.get_output_path() \
+        and not Includes.changed(lock.get('dependencies', {})) \
+        and not Environment.changed(lock.get('environment', {}))
 
 
 
-def read_lock_file(path):
+def plan(rules = None):
     '''
-    Read a JSON file into a dictionary allowing us to do
-    quick lookups for specific files whenever we need to check
-    if one was already parsed or not, allowing us to skip part of the
-    process.
+    Work out what a run would do without doing any of it. Files that
+    haven't changed since the last run are skipped the same way, and the
+    rest are rendered and compared against what's saved right now.
 
     Parameters:
-        path (str): The directory of the lock file
+        rules (dict): The rules to use instead of the #ix-config headers, if any
+
+    Returns:
+        dict: The outputs that would be created, changed, or removed,
+        and how many files would stay the same
     '''
-    try:
-        file = open(path + '/ix.lock')
-        contents = json.loads(file.read())
-        file.close()
-        return contents
-    except FileNotFoundError:
-        # Start fresh if the file doesn't exist
-        return {}
+    result = { 'created': [], 'changed': [], 'removed': [], 'unchanged': 0 }
+    before = stats['unchanged']
+    outputs = {}
 
+    Parser.unreadable.clear()
 
+    def check(file):
+        output = file.get_output_path()
+        outputs[file.original_path] = output
+        count('discovered')
 
-def save_lock_file(path, data):
-    '''
-    Save a dictionary full of all parsed files to a file.
-    This will be used later on when 'ix' runs again in order
-    to check which files have changed and only re-process those files.
+        if use_cache and unchanged(file) and os.path.exists(destination(output)):
+            count('unchanged')
+            return None
 
-    Giving a bit of a performance boost in very large directories.
+        return file
 
-    Parameters:
-        path (str): The directory of the lock file
-        data (dict): Dictionary full of all the file data that we care about saving
-    '''
-    if not os.path.isdir(path):
-        os.makedirs(path)
+    def compare(file):
+        processed = Parser.render(file)
 
-    with open(path + '/ix.lock', 'w') as lock:
-        lock.write(json.dumps(data))
+        if processed is None:
+            return None
 
+        if isinstance(processed, list):
+            processed = b''.join(processed)
 
+        path = destination(file.get_output_path())
 
-def cleanup():
-    '''
-    Attempt to remove all the files that were previously
-    processed and stored in the cache, making sure to 
-    clear the cache when done so we're starting fresh.
-    '''
-    lock = read_lock_file(lock_path)
+        try:
+            with open(path, 'rb') as f:
+                same = f.read() == processed
 
-    info('Purging all previous builds...', True)
+            if file.has_custom_access:
+                same = same and os.stat(path).st_mode & 0o7777 == file.access
+        except OSError:
+            return ('created', file.get_output_path())
 
-    if lock == {}:
-        log('Found no items in cache, exiting...', True)
+        return (None if same else 'changed', file.get_output_path())
 
-    for _, entry in lock.items():
-        file = entry['output']
+    pipeline = Pipeline() \
+        .source(discover(rules)) \
+        .stage(Parser.sniff, jobs) \
+        .stage(check, jobs, order = File.rank) \
+        .stage(compare, jobs)
 
-        try:
-            os.remove(file)
-            log(f'\tRemoved: {file}')
-        except Exception as e:
-            error(f"Couldn't remove: {file} - {e!r}")
+    for change, output in pipeline.drain():
+        if change:
+            result[change].append(output)
+        else:
+            result['unchanged'] += 1
 
-    save_lock_file(lock_path, {})
-    success('Done', True)
+    result['unchanged'] += stats['unchanged'] - before
+    result['removed'] = [ output for _, output in stale(outputs) if output ]
 
+    for change in [ 'created', 'changed', 'removed' ]:
+        result[change].sort()
 
+    return result
 
-def main(rules = None):
+
+
+def build(source, lock_directory, unreadable = (), found = False):
     '''
-    The main entrypoint for the program.
-    Initializes everything that needs to happen.
-    From finding all the 'ix' files to creating new Threads for
-    parsing each of the available files, as well as saving and updating
-    the lock file once everything has been processed.
+    Process every file that has changed since the last run and update
+    the lock file. Files go through a pipeline of steps that all run at
+    the same time: finding them, checking them against the lock file,
+    rendering them, saving them, and updating the lock file.
 
-    Args:
-        args (dict): The arguments passed to the program
+    Parameters:
+        source (iterable): The files, or paths to possible files, to process
+        lock_directory (str): Where the lock file for these files is stored
+        unreadable (set): Files that couldn't be read when the files
+        were found beforehand, like they are for profiles
+        found (bool): Whether the files were found, and counted, beforehand
     '''
-    threads = list()
+    # Only what couldn't be read this time counts
+    Parser.unreadable.clear()
+    Parser.unreadable.update(unreadable)
 
-    if rules:
-        files = list()
-        
-        for f in rules['parse']:
-            root, name = f['file'].rsplit('/', 1)
+    before = dict(stats)
+    outputs = {}
 
-            if not os.path.isfile(f['file']):
-                error('Could not find file: ' + f['file'])
-                continue
+    # Files get recorded as they're saved, what they saved
+    # to before is needed to find out what moved
+    previous = { source: entry['output'] for source, entry in lock_file.items() }
 
-            file = File(root, name, rules = f)
+    # Only whole runs keep the index up to date,
+    # a bundle has no lock file to go with it
+    Index.directory = None
 
-            for field in f.items():
-                file.load_field(field)
+    if not shard and not Bundle.archive:
+        Index.open(lock_directory)
 
-            files.append(file)
-    else:
-        files = Parser.find_ix(root_path)
+    def check(file):
+        outputs[file.original_path] = file.get_output_path()
 
-    unchanged = 0
-    saved = 0
+        if not found:
+            count('discovered')
 
-    if len(files) > 0:
-        info('Found {} ix compatible files'.format(len(files)))
-    else:
-        log('Found no ix compatible files in: {}.'.format(root_path))
-        log('Exiting.')
-        return
+        if not use_cache or file.original_path not in lock_file:
+            return file
 
-    for file in files:
-        if file.original_path in lock_file:
-            hash = file.hash_contents()
-            lock = lock_file[file.original_path]
+        unchanged_file = unchanged(file)
 
-            # Don't run for files that haven't changed
-            if lock and hash == lock['hash']:
-                unchanged += 1
-                continue
+        # A new generation needs to contain everything, the unchanged
+        # files can be taken from the previous one if it has them
+        if unchanged_file and (not generations or Generations.carry(file.get_output_path())):
+            count('unchanged')
+            return None
 
-        thread = threading.Thread(target=Parser.process_file, args=(file,))
-        threads.append(thread)
-        thread.start()
+        return file
+
+    if io_backend == 'async':
+        AsyncPipeline(jobs).run(source, check)
+    else:
+        pipeline = Pipeline() \
+            .source(source) \
+            .stage(Parser.sniff, jobs) \
+            .stage(check, jobs, order = File.rank) \
+            .stage(lambda file: (file, Parser.render(file)), jobs) \
+            .stage(lambda item: Parser.save_file(*item) if item[1] is not None else None, jobs)
+
+        # Only this thread touches the lock file
+        for file in pipeline.drain():
+            Parser.record_file(file)
 
-        saved += 1
+    # A bundle doesn't replace anything on this machine
+    if not Bundle.archive:
+        prune(outputs, previous)
 
-    for thread in threads:
-        thread.join()
+    if use_store and not Bundle.archive:
+        Store.collect()
+
+    discovered = len(outputs)
+    saved = stats['rendered'] - before['rendered']
+    skipped = stats['unchanged'] - before['unchanged']
 
     # Logging
+    if discovered > 0:
+        info('Found {} ix compatible files'.format(discovered))
+    else:
+        log('Found no ix compatible files in: {}.'.format(root_path))
+
     if saved > 0:
         success('Saved {} files'.format(saved), True)
 
-    if unchanged > 0:
-        log('Skipped {} files because they were unchanged'.format(unchanged))
+    if skipped > 0:
+        log('Skipped {} files because they were unchanged'.format(skipped))
 
-    # Cache all the parsed files
-    save_lock_file(lock_path, lock_file)
+    # Cache all the parsed files, only the ones from
+    # this shard if it's just a part of the run
+    if Bundle.archive:
+        return
+    elif shard:
+        partial = { source: entry for source, entry in lock_file.items() if in_shard(source) }
+        save_lock_file(lock_directory, partial, 'ix.shard-{}-of-{}.lock'.format(*shard))
+    else:
+        save_lock_file(lock_directory, lock_file)
+        Index.close()
 
 
 
@@ -943,40 +4674,173 @@ sequence = [ '{{', '}}' ]
 root_path = os.path.expandvars('$HOME/dots')
 config_path = os.path.expandvars('$HOME/.config/ix/ixrc')
 lock_path = os.path.expandvars('$HOME/.cache/ix')
+helpers_path = os.path.expandvars('$HOME/.config/ix/helpers')
+metrics_path = None
+bundle_path = None
+output_root = None
+generations = False
+generations_kept = 3
+
+# Which part of the files to process, as (index, total), if not all of them
+shard = None
+
+# Whether to save outputs through the content addressed store
+use_store = False
+
+# Whether to use the git index to skip reading unmodified files
+use_git = False
+
+# Files of at least this many bytes get mapped instead of read
+map_threshold = 1024 * 1024
+
+# Whether to only work out what a run would do, without writing anything
+planning = False
+
+# How many threads each step of processing files can use,
+# or how many files can be in progress at once with 'async'
+jobs = min(32, (os.cpu_count() or 1) + 4)
+io_backend = 'threads'
+use_cache = True
 lock_file = None
 config = None
 
+# The cached configuration layers, once something in them changed
+config_cache = None
+
+# Profiles, each one being a (name, config, output directory) tuple
+profiles = []
+
 # Commandline arguments
 parser = argparse.ArgumentParser(description='Find and replace variables in files within a given directory')
-parser.add_argument('-c', '--config', help='The path where the .ix configuration is located. Default $HOME/.config/ix/ixrc')
-parser.add_argument('-r', '--rules', help='File that contains a list of all files to be parsed and included. Used instead of the #ix-config header in each individual file')
+parser.add_argument('command', help='merge-locks: combine the lock files of every shard (or the given ones) into a single one. where: list every file that uses the given config keys or helper expressions', nargs='?', choices=['merge-locks', 'where'])
+parser.add_argument('arguments', help='Arguments for the command', nargs='*')
+parser.add_argument('-c', '--config', help='The path where the .ix configuration is located. Default $HOME/.config/ix/ixrc. Can be used multiple times, each one overriding the ones before it', action='append')
+parser.add_argument('-r', '--rules', help='File that contains a list of all files to be parsed and included, either as JSON or JSON lines. Used instead of the #ix-config header in each individual file')
+parser.add_argument('--helpers', help='The directory to load extra helpers from. Default $HOME/.config/ix/helpers')
 parser.add_argument('-d', '--directory', help='The directory to parse. Default $HOME/dots')
 parser.add_argument('-f', '--field', help='Get a specific field value from the config')
 parser.add_argument('--full', help='Skip looking at the cache and parse everything', action='store_false')
 parser.add_argument('--reverse', help='Remove all the parsed files (everything defined in the cache)', action='store_true')
+parser.add_argument('-p', '--profile', help='Process every file with the given config, saving everything under the given output directory. Can be used multiple times', nargs=3, action='append', metavar=('NAME', 'CONFIG', 'OUTPUT'))
+parser.add_argument('-g', '--generations', help='Save every run to a new generation and activate all of its files at once', action='store_true')
+parser.add_argument('--rollback', help='Activate the generation before the current one', action='store_true')
+parser.add_argument('-j', '--jobs', help='How many files can be processed at the same time', type=int)
+parser.add_argument('--io', help='How files are read and written. Use async on high latency file systems like NFS', choices=['threads', 'async'], default='threads')
+parser.add_argument('-s', '--shard', help='Only process one part of the files, given as i/N, and save a partial lock file')
+parser.add_argument('-b', '--bundle', help='Save every processed file into a single archive (.tar, .tar.gz, .tar.xz, .zip) instead of the file system')
+parser.add_argument('--git', help='Use the git index of the repository the files are in to skip reading files that were not modified', action='store_true')
+parser.add_argument('--store', help='Write every different output only once, into a store within the cache, and hardlink it to where it belongs', action='store_true')
+parser.add_argument('-t', '--timeout', help='How many seconds a single file can take to process before giving up on it', type=float)
+parser.add_argument('--helper-timeout', help='How many seconds a single helper can take before giving up on the file using it', type=float)
+parser.add_argument('--deadline', help='How many seconds the whole run can take. Files that are not processed by then are skipped until the next run', type=float)
+parser.add_argument('-m', '--metrics', help='Write statistics about the run to the given file in the prometheus textfile format')
+parser.add_argument('--plan', help='Print what a run would create, change, or remove as JSON, without writing anything. Exits with 2 if anything would change', action='store_true')
+parser.add_argument('--log-format', help='How messages are written out. Use json to get one JSON object per line', choices=['text', 'json'], default='text')
 parser.add_argument('-v', '--verbose', help='Output extra information about what is happening', action='store_true')
 
 args = parser.parse_args()
 json_rules = None
 
-if args.rules:
-    with open(args.rules) as file:
-        json_rules = json.load(file)
-
 if args.verbose:
     verbose = True;
 
+# Whatever is still buffered gets written out on the way out
+Log.format = args.log_format
+atexit.register(Log.close)
+
+if args.metrics:
+    metrics_path = os.path.expandvars(args.metrics)
+
+if args.bundle:
+    bundle_path = os.path.expandvars(args.bundle)
+
+use_store = args.store
+use_git = args.git
+
+if args.jobs:
+    jobs = max(1, args.jobs)
+
+io_backend = args.io
+
+if args.helpers:
+    helpers_path = os.path.expandvars(args.helpers)
+
+Budget.file = args.timeout
+Budget.helper = args.helper_timeout
+
+if args.deadline is not None:
+    Budget.deadline = time.monotonic() + args.deadline
+
+# Nothing can be written from here on when planning,
+# not even the caches
+if args.plan:
+    if args.profile or args.generations or args.rollback or args.bundle or args.shard:
+        error('A plan can not be made together with profiles, generations, bundles or shards', True)
+        exit(1)
+
+    planning = True
+
+if args.rules:
+    json_rules = Rules.read(os.path.expandvars(args.rules))
+
+if args.shard:
+    try:
+        index, total = [ int(x) for x in args.shard.split('/') ]
+        assert 1 <= index <= total
+    except (ValueError, AssertionError):
+        error('Invalid shard, expected i/N with 1 <= i <= N: ' + args.shard, True)
+        exit(1)
+
+    shard = (index, total)
+
+if args.generations or args.rollback:
+    if args.profile or args.shard or args.bundle:
+        error('Generations can not be used together with profiles, shards or bundles', True)
+        exit(1)
+
+    generations = True
+
+if args.profile:
+    profiles = [ (name, os.path.expandvars(at), output) for name, at, output in args.profile ]
+
+    # Everything gets found using the first profile
+    config_path = profiles[0][1]
+    output_root = os.path.expandvars(profiles[0][2])
+
 if args.config:
     if args.rules:
         config_path = json_rules['vars_file']
     else:
         config_path = args.config
 
+if args.command == 'merge-locks':
+    paths = args.arguments or sorted(str(path) for path in pathlib.Path(lock_path).glob('ix.shard-*.lock'))
+    locks = [ read_lock_file(os.path.dirname(path) or '.', os.path.basename(path)) for path in paths ]
+
+    save_lock_file(lock_path, merge_locks(locks))
+    success('Merged {} lock files into {}'.format(len(paths), os.path.join(lock_path, 'ix.lock')), True)
+    exit()
+
+if args.command == 'where':
+    Index.open(lock_path)
+    found = {}
+
+    for key in args.arguments:
+        found.update(Index.where(key))
+
+    for source, output in sorted(found.items()):
+        print(f'{source}\t{output}')
+
+    exit(0 if found else 1)
+
 if args.field:
     config = read_config(config_path)
     contents = Parser.get_main_key_value(args.field)
     print(contents)
 
+    if args.field.strip() in config.origin:
+        log('Defined in: ' + config.origin[args.field.strip()], True)
+
     # The whole thing doesn't need to run
     # if only one field is needed
     exit()
@@ -987,12 +4851,11 @@ if args.directory:
     else:
         root_path = pathlib.Path(os.path.expandvars(args.directory)).absolute()
 
-# Load in the cache if not specified
-# otherwise.
-if not args.full:
-    lock_file = {}
-else:
-    lock_file = read_lock_file(lock_path)
+# Load in the cache. It's still needed when doing
+# a full parse to find out what was removed.
+# Bundles always need every file.
+use_cache = args.full and not args.bundle
+lock_file = read_lock_file(lock_path)
 
 
 # Load in the config
@@ -1005,11 +4868,24 @@ if __name__ == '__main__':
     if os.name == 'nt':
         os.system('color')
 
-    if not args.full:
-        info('Skipping cache, doing a full parse...', True)
-        cleanup()
-    
     if args.reverse:
         cleanup()
+        exit()
+
+    if args.rollback:
+        Generations.rollback()
+        exit()
+
+    if not args.full:
+        info('Skipping cache, doing a full parse...', True)
+
+    if planning:
+        if use_git:
+            Git.load(root_path)
+
+        changes = plan(json_rules)
+        print(json.dumps(changes, indent = 4))
+
+        exit(2 if changes['created'] or changes['changed'] or changes['removed'] else 0)
 
     main(rules = json_rules)
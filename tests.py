@@ -9,6 +9,20 @@ test_directory = './tests'
 
 class TestIxParsing(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        import ix, tempfile
+
+        # Keep every cache out of the real lock directory
+        cls.cache = tempfile.TemporaryDirectory()
+        ix.lock_path = cls.cache.name
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.cache.cleanup()
+
+
     def test_find_ix(self):
         import ix
         from ix import Parser
@@ -106,6 +120,36 @@ class TestIxParsing(unittest.TestCase):
         self.assertEqual(file.get_output_path(), file.to + '/testName')
 
 
+    def test_output_directory_cache(self):
+        '''
+        Make sure output directories are only expanded and
+        created once, even when used by multiple files.
+        '''
+        import ix, tempfile
+        from ix import Directories
+
+        ix.config = ix.read_config('./tests/no_as/ixrc')
+        Directories.reset()
+
+        first = Directories.expand('$HOME/#{{ paths.users }}', '#')
+        second = Directories.expand('$HOME/#{{ paths.users }}', '#')
+
+        self.assertTrue(first is second)
+        self.assertTrue(first[0].endswith('/palace'))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + '/one/two'
+
+            Directories.create(path, 'first')
+            os.rmdir(path)
+            Directories.create(path, 'second')
+
+            # Only created the first time
+            self.assertFalse(os.path.isdir(path))
+
+        Directories.reset()
+
+
     def test_file_permissions(self):
         '''
         Test that the access configuration field updates the final file
@@ -126,6 +170,29 @@ class TestIxParsing(unittest.TestCase):
         self.assertTrue(os.access(output_path, os.X_OK))
 
 
+    def test_file_record(self):
+        '''
+        Make sure files are stored without a per instance dictionary
+        and that the flags and hash still behave like attributes.
+        '''
+        from ix import File
+
+        file = File('./tests/simple', 'simple')
+
+        self.assertFalse(hasattr(file, '__dict__'))
+        self.assertFalse(file.has_custom_access)
+
+        file.load_field(('access', '644'))
+
+        self.assertTrue(file.has_custom_access)
+        self.assertFalse(file.has_custom_dir)
+        self.assertEqual(file.flags, File.CUSTOM_ACCESS)
+
+        file.hash_contents()
+        self.assertEqual(len(file.hash), 32)
+        self.assertEqual(len(file.digest), 16)
+
+
     def test_ix_extension_when_in_the_same_directory(self):
         '''
         Make sure that the processed file gets saved with an '.ix'
@@ -173,6 +240,122 @@ class TestIxParsing(unittest.TestCase):
         self.assertTrue(parsed.count('@{{') == 0)
 
 
+    def test_environment_variables(self):
+        '''
+        Make sure environment variables in the config are expanded
+        from the snapshot, and that every file remembers which ones
+        it used so changing them invalidates the file.
+        '''
+        import ix
+        from ix import Parser, Environment
+
+        Environment.variables['IX_TEST_HOME'] = '/home/test'
+
+        ix.root_path = test_directory + '/with_environment'
+        ix.config = ix.read_config(ix.root_path + '/ixrc')
+
+        file = Parser.find_ix(ix.root_path).pop()
+
+        self.assertTrue('/home/test/config' in file.parse())
+        self.assertEqual(file.variables, { 'IX_TEST_HOME' })
+
+        digests = Environment.digests(file.variables)
+        self.assertFalse(Environment.changed(digests))
+
+        Environment.variables['IX_TEST_HOME'] = '/home/other'
+        self.assertTrue(Environment.changed(digests))
+
+        del Environment.variables['IX_TEST_HOME']
+
+
+    def test_encoding(self):
+        '''
+        Make sure files that aren't UTF-8 still get processed, with
+        everything but the variables left exactly as it was.
+        '''
+        import ix
+        from ix import Parser
+
+        ix.root_path = test_directory + '/with_encoding'
+        ix.config = ix.read_config(ix.root_path + '/ixrc')
+
+        file = Parser.find_ix(ix.root_path).pop()
+
+        self.assertEqual(file.render(), '\nCaf\xe9 CoolValue na\xefve\n'.encode('latin-1'))
+
+
+    def test_mapped_files(self):
+        '''
+        Make sure large files that get mapped instead of read come
+        out exactly the same, with their plain text kept as slices
+        of the mapping.
+        '''
+        import ix, tempfile
+        from ix import Parser
+
+        threshold = ix.map_threshold
+
+        for name in [ 'with_variables', 'helpers_inclusion', 'with_encoding' ]:
+            ix.root_path = test_directory + '/' + name
+            ix.config = ix.read_config(ix.root_path + '/ixrc')
+
+            ix.map_threshold = threshold
+            read = Parser.find_ix(ix.root_path).pop()
+
+            ix.map_threshold = 1
+            mapped = Parser.find_ix(ix.root_path).pop()
+
+            self.assertFalse(read.source)
+            self.assertTrue(mapped.source)
+            self.assertEqual(mapped.hash_contents(), ix.hash_file(mapped.original_path))
+
+            pieces = mapped.render()
+
+            self.assertTrue(any(isinstance(piece, memoryview) for piece in pieces))
+            self.assertEqual(b''.join(pieces), read.render())
+            self.assertEqual(mapped.parse(), read.parse())
+
+            with tempfile.TemporaryDirectory() as directory:
+                mapped.to = directory
+                Parser.save_file(mapped, pieces)
+
+                with open(mapped.get_output_path(), 'rb') as f:
+                    self.assertEqual(f.read(), read.render())
+
+        ix.map_threshold = threshold
+
+
+    def test_palette(self):
+        '''
+        Make sure colors from the config are parsed when it's loaded,
+        and that every variant formatted from the palette is exactly
+        what the helpers would make out of the strings.
+        '''
+        import ix
+        from ix import Helpers, Palette
+
+        ix.config = ix.read_config(test_directory + '/helpers_colors/ixrc')
+
+        self.assertEqual(Palette.colors['#0000004c'], (0, 0, 0, 0x4c / 255, '000000', True))
+        self.assertEqual(Palette.colors['rgb(242, 242, 242)'], (242, 242, 242, None, 'f2f2f2', False))
+        self.assertIsNone(Palette.find('rgb(10%, 0, 0)'))
+        self.assertIsNone(Palette.find('monospace'))
+
+        values = [ '#181b21', '#181B2177', '#00000000', 'rgb(5, 27, 233)', 'rgba(255, 10, 0, 0.3)' ]
+        modifiers = [ {}, { 'alpha': '0.5' }, { 'argb': 'true' }, { 'alpha': '0.25', 'argb': 'true' } ]
+
+        for value in values:
+            for modifier in modifiers:
+                alpha = modifier.get('alpha')
+                parsed = (Helpers.rgb(value, alpha), Helpers.hex(value, **modifier))
+
+                Palette.colors[value] = None
+                plain = (Helpers.rgb(value, alpha), Helpers.hex(value, **modifier))
+                del Palette.colors[value]
+
+                self.assertEqual(parsed, plain)
+
+
     def test_helper_file_inclusion(self):
         import ix
         from ix import Parser
@@ -186,6 +369,46 @@ class TestIxParsing(unittest.TestCase):
         self.assertTrue('UNIQUE{ TEMPLATE_CONTENT }' in parsed)
 
 
+    def test_helper_file_inclusion_dependencies(self):
+        '''
+        Make sure included files get recorded as dependencies
+        of the file including them, with the hash they had.
+        '''
+        import ix
+        from ix import Parser, Includes
+
+        ix.root_path = test_directory + '/helpers_inclusion'
+        ix.config = ix.read_config(ix.root_path + '/ixrc')
+
+        file = Parser.find_ix(ix.root_path).pop()
+        file.parse()
+
+        included = os.path.abspath(ix.root_path + '/first')
+
+        self.assertEqual(list(file.dependencies), [included])
+        self.assertFalse(Includes.changed(file.dependencies))
+        self.assertTrue(Includes.changed({ included: 'outdated' }))
+
+
+    def test_helper_file_inclusion_cycle(self):
+        '''
+        Make sure files including each other don't recurse forever.
+        '''
+        import ix
+        from ix import Parser
+
+        ix.root_path = test_directory + '/helpers_include_cycle'
+        ix.config = ix.read_config(ix.root_path + '/ixrc')
+
+        file = Parser.wrap_file(ix.root_path + '/first')
+        parsed = file.parse()
+
+        self.assertTrue('FIRST_CONTENT' in parsed)
+        self.assertTrue('SECOND_CONTENT' in parsed)
+        self.assertEqual(parsed.count('FIRST_CONTENT'), 1)
+        self.assertTrue(os.path.abspath(ix.root_path + '/second') in file.dependencies)
+
+
     def test_helper_casing(self):
         import ix
         from ix import Parser
@@ -287,6 +510,1003 @@ class TestIxParsing(unittest.TestCase):
         self.assertTrue('coolvalue' in parsed)
 
 
+    def test_metrics_export(self):
+        '''
+        Make sure the run statistics get exported in the
+        prometheus textfile format and that no temporary
+        files are left behind.
+        '''
+        import ix
+
+        ix.lock_file = {}
+        path = test_directory + '/metrics/ix.prom'
+
+        ix.count('rendered', 2)
+        ix.save_metrics(path, 1.5)
+
+        with open(path) as f:
+            metrics = f.read()
+
+        self.assertTrue('# TYPE ix_files_rendered gauge' in metrics)
+        self.assertTrue('ix_run_duration_seconds 1.5\n' in metrics)
+        self.assertTrue('ix_lock_entries 0\n' in metrics)
+        self.assertEqual(os.listdir(test_directory + '/metrics'), ['ix.prom'])
+
+
+    def test_profiles(self):
+        '''
+        Make sure a file that was found once can be processed
+        again with a different configuration, and that the output
+        root gets applied to where it's saved.
+        '''
+        import ix
+        from ix import Parser
+
+        ix.root_path = test_directory + '/profiles/dots'
+        ix.config = ix.read_config(test_directory + '/profiles/dark')
+
+        dark = Parser.find_ix(ix.root_path).pop()
+        self.assertTrue('rgb(0, 0, 0)' in dark.parse())
+        self.assertTrue(dark.get_output_path().endswith('/dark/theme'))
+
+        ix.config = ix.read_config(test_directory + '/profiles/light')
+
+        light = dark.rebind()
+        self.assertTrue('rgb(255, 255, 255)' in light.parse())
+        self.assertTrue(light.get_output_path().endswith('/light/theme'))
+
+        ix.output_root = '/output/light'
+        self.assertEqual(ix.destination('/etc/theme'), '/output/light/etc/theme')
+        ix.output_root = None
+
+
+    def test_profiles_config(self):
+        '''
+        Make sure every profile saves to where its own config says,
+        even when a different config was given for the whole run.
+        '''
+        import ix, tempfile
+
+        ix.root_path = test_directory + '/profiles/dots'
+        ix.config = ix.read_config(test_directory + '/profiles/light')
+        ix.lock_file = {}
+
+        with tempfile.TemporaryDirectory() as directory:
+            ix.profiles = [
+                (name, test_directory + '/profiles/' + name, directory + '/' + name)
+                for name in [ 'dark', 'light' ]
+            ]
+
+            discovered = ix.stats['discovered']
+
+            try:
+                ix.process_all()
+            finally:
+                ix.profiles = []
+                ix.output_root = None
+                ix.Template.keep = False
+
+            # The same file for both profiles
+            self.assertEqual(ix.stats['discovered'], discovered + 1)
+
+            for name, color in [ ('dark', 'rgb(0, 0, 0)'), ('light', 'rgb(255, 255, 255)') ]:
+                with open(ix.destination(test_directory + '/profiles/' + name + '/theme', directory + '/' + name)) as f:
+                    self.assertTrue(color in f.read())
+
+
+    def test_prune(self):
+        '''
+        Make sure only the outputs of files that were removed or
+        that save somewhere else now get removed, along with their
+        entries in the lock file.
+        '''
+        import ix, tempfile
+        from ix import Parser
+
+        ix.root_path = test_directory + '/simple'
+        file = Parser.find_ix(ix.root_path).pop()
+
+        with tempfile.TemporaryDirectory() as directory:
+            removed = directory + '/removed'
+            retargeted = directory + '/retargeted'
+
+            for path in [ removed, retargeted ]:
+                open(path, 'w').close()
+
+            ix.lock_file = {
+                directory + '/gone': { 'output': removed },
+                file.original_path: { 'output': retargeted },
+                '/outside/the/root': { 'output': file.get_output_path() }
+            }
+
+            ix.prune({ file.original_path: file.get_output_path() })
+
+            self.assertFalse(os.path.exists(removed))
+            self.assertFalse(os.path.exists(retargeted))
+            self.assertEqual(ix.lock_file, {})
+
+
+    def test_prune_unreadable(self):
+        '''
+        Make sure files that couldn't be sniffed keep their output,
+        while files that were read and lost their header don't.
+        '''
+        import ix, tempfile
+        from ix import Parser
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(directory + '/ixrc', 'w') as f:
+                f.write('[data]\nvalue = one\n')
+
+            for name in [ 'typo', 'plain' ]:
+                with open(directory + '/' + name, 'w') as f:
+                    f.write('#: ix-config\n' + name + '\n')
+
+            ix.lock_file = {}
+            ix.root_path = directory
+            ix.config = ix.read_config(directory + '/ixrc')
+            ix.build(Parser.walk(directory), directory + '/cache')
+
+            with open(directory + '/typo', 'w') as f:
+                f.write('#: ix-config\n#: access: nope\ntypo\n')
+
+            with open(directory + '/plain', 'w') as f:
+                f.write('plain\n')
+
+            ix.build(Parser.walk(directory), directory + '/cache')
+
+            self.assertTrue(os.path.exists(directory + '/typo.ix'))
+            self.assertTrue(directory + '/typo' in ix.lock_file)
+            self.assertFalse(os.path.exists(directory + '/plain.ix'))
+            self.assertFalse(directory + '/plain' in ix.lock_file)
+
+            # Once the header is gone for good, the next run removes it
+            with open(directory + '/typo', 'w') as f:
+                f.write('typo\n')
+
+            ix.build(Parser.walk(directory), directory + '/cache')
+
+            self.assertFalse(os.path.exists(directory + '/typo.ix'))
+            self.assertFalse(directory + '/typo' in ix.lock_file)
+
+
+    def test_prune_moved(self):
+        '''
+        Make sure a file that saves somewhere else now has its old
+        output removed by the run that saves it to the new place.
+        '''
+        import ix, tempfile
+        from ix import Parser
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(directory + '/ixrc', 'w') as f:
+                f.write('[data]\nvalue = one\n')
+
+            ix.lock_file = {}
+            ix.root_path = directory
+            ix.config = ix.read_config(directory + '/ixrc')
+
+            for target in [ 'one', 'two' ]:
+                with open(directory + '/moved', 'w') as f:
+                    f.write(f'#: ix-config\n#: to: { directory }/{ target }\nmoved\n')
+
+                ix.build(Parser.walk(directory), directory + '/cache')
+
+            self.assertFalse(os.path.exists(directory + '/one/moved'))
+            self.assertTrue(os.path.exists(directory + '/two/moved'))
+            self.assertEqual(ix.lock_file[directory + '/moved']['output'], directory + '/two/moved')
+
+
+    def test_shards(self):
+        '''
+        Make sure every file belongs to exactly one shard and
+        that merging the lock files of every shard keeps the
+        most recent entry of each file.
+        '''
+        import ix
+        from ix import Parser
+
+        ix.root_path = test_directory
+        paths = list(Parser.walk(test_directory))
+
+        owners = []
+
+        for index in range(1, 4):
+            ix.shard = (index, 3)
+            owners += [ path for path in paths if ix.in_shard(path) ]
+
+        ix.shard = None
+
+        self.assertEqual(sorted(owners), sorted(paths))
+
+        merged = ix.merge_locks([
+            { 'a': { 'hash': 'old', 'created_at': '2021-01-01' }, 'b': { 'hash': 'b' } },
+            { 'a': { 'hash': 'new', 'created_at': '2021-01-02' } },
+            { 'a': { 'hash': 'older', 'created_at': '2020-01-01' } }
+        ])
+
+        self.assertEqual(merged['a']['hash'], 'new')
+        self.assertEqual(merged['b']['hash'], 'b')
+
+        # Times are compared as times, however they're written
+        merged = ix.merge_locks([
+            { 'a': { 'hash': 'new', 'created_at': '2021-01-01 10:00:05' } },
+            { 'a': { 'hash': 'old', 'created_at': '2021-01-01T10:00:04.900000' } }
+        ])
+
+        self.assertEqual(merged['a']['hash'], 'new')
+
+
+    def test_helper_plugins(self):
+        '''
+        Make sure helpers from the helpers directory are only imported
+        once they're used, and that pure helpers with a batch function
+        convert every value within a file in one go.
+        '''
+        import ix
+        from ix import Parser, Helpers
+
+        ix.root_path = test_directory + '/helpers_plugins'
+        ix.helpers_path = ix.root_path + '/helpers'
+        ix.config = ix.read_config(ix.root_path + '/ixrc')
+
+        Helpers.available = None
+        self.assertFalse('shout' in Helpers.registry)
+
+        file = Parser.wrap_file(ix.root_path + '/main')
+        parsed = file.parse()
+
+        self.assertTrue('#FF0000!' in parsed)
+        self.assertTrue('#00FF00!' in parsed)
+        self.assertTrue('rgb(255, 0, 0)' in parsed)
+
+        shout, pure, batch = Helpers.registry['shout']
+        calls = shout.__globals__['calls']
+
+        self.assertTrue(pure)
+        self.assertEqual(calls, [ [ '#00ff00', '#ff0000' ], [ '#ff0000' ] ])
+
+        file.parse()
+        self.assertEqual(len(calls), 2)
+
+        # Nothing gets written into the helpers directory
+        self.assertEqual(os.listdir(ix.helpers_path), [ 'shout.py' ])
+
+        del Helpers.registry['shout']
+        Helpers.available = None
+
+
+    def test_time_budgets(self):
+        '''
+        Make sure work that takes too long is given up on, and that
+        files with a slow helper, or files rendered after the run is
+        out of time, are left unsaved without holding anything up.
+        '''
+        import ix, time
+        from ix import Parser, Helpers, Budget, TimedOut
+
+        self.assertEqual(Budget.run(lambda: 'done', 1), 'done')
+
+        with self.assertRaises(TimedOut):
+            Budget.run(lambda: time.sleep(1), 0.05)
+
+        ix.root_path = test_directory + '/with_timeout'
+        ix.config = ix.read_config(ix.root_path + '/ixrc')
+
+        file = Parser.find_ix(ix.root_path).pop()
+        timed_out = ix.stats['timed_out']
+
+        Helpers.registry['stall'] = (lambda value: time.sleep(1) or value, False, None)
+
+        try:
+            self.assertTrue(b'CoolValue' in Parser.render(file))
+
+            Budget.helper = 0.05
+            start = time.monotonic()
+
+            self.assertIsNone(Parser.render(file))
+            self.assertLess(time.monotonic() - start, 0.5)
+
+            Budget.helper = None
+            Budget.deadline = time.monotonic() - 1
+
+            self.assertIsNone(Parser.render(file))
+            self.assertEqual(ix.stats['timed_out'], timed_out + 2)
+        finally:
+            Budget.helper = None
+            Budget.deadline = None
+            del Helpers.registry['stall']
+
+
+    def test_nested_include_budget(self):
+        '''
+        Make sure includes within includes render right away when the
+        helpers have a time limit, and that files including the same
+        file at the same time all get it while it's rendered only once.
+        '''
+        import ix, tempfile, time, threading
+        from ix import Parser, Includes, Budget
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(directory + '/ixrc', 'w') as f:
+                f.write('[paths]\ntemplates = ' + directory + '\n')
+
+            with open(directory + '/middle', 'w') as f:
+                f.write('#: ix-config\nMIDDLE #{{ include [ paths.templates ]/leaf }}\n')
+
+            with open(directory + '/leaf', 'w') as f:
+                f.write('LEAF\n')
+
+            for number in range(8):
+                with open(directory + f'/main{ number }', 'w') as f:
+                    f.write(f'#: ix-config\nMAIN{ number } #{{{{ include [ paths.templates ]/middle }}}}\n')
+
+            ix.root_path = directory
+            ix.config = ix.read_config(directory + '/ixrc')
+
+            render = Includes.render
+            rendered = []
+
+            def counted(path):
+                rendered.append(path)
+                return render(path)
+
+            Includes.render = counted
+
+            try:
+                for helper, deadline in [ (1, None), (None, 3), (1, 3) ]:
+                    Includes.cache.clear()
+                    rendered.clear()
+
+                    Budget.helper = helper
+                    Budget.deadline = deadline and time.monotonic() + deadline
+
+                    results = {}
+                    files = [ Parser.wrap_file(directory + f'/main{ number }') for number in range(8) ]
+                    threads = [ threading.Thread(target = lambda file = file: results.update({ file.name: Parser.render(file) })) for file in files ]
+
+                    start = time.monotonic()
+
+                    for thread in threads: thread.start()
+                    for thread in threads: thread.join()
+
+                    self.assertLess(time.monotonic() - start, 0.5)
+                    self.assertEqual(len(rendered), 2)
+
+                    for number in range(8):
+                        self.assertTrue(b'MIDDLE LEAF' in results[f'main{ number }'])
+            finally:
+                Includes.render = render
+                Budget.helper = None
+                Budget.deadline = None
+
+
+    def test_pipeline(self):
+        '''
+        Make sure items flow through every step, that steps can drop
+        items, and that a failing item doesn't stop the rest.
+        '''
+        from ix import Pipeline
+
+        def fail_on_five(item):
+            if item == 5:
+                raise ValueError('five')
+
+            return item
+
+        pipeline = Pipeline(size = 2) \
+            .source(iter(range(20))) \
+            .stage(lambda item: item if item % 2 else None, 3) \
+            .stage(fail_on_five, 2) \
+            .stage(lambda item: item * 10, 4)
+
+        self.assertEqual(sorted(pipeline.drain()), [ 10, 30, 70, 90, 110, 130, 150, 170, 190 ])
+
+
+    def test_scheduling(self):
+        '''
+        Make sure files with a higher priority come first, then the
+        ones that took the longest last time, or are the largest.
+        '''
+        import ix, queue
+        from ix import File, Pipeline
+
+        ix.lock_file = {}
+
+        small = File(test_directory + '/simple', 'simple2')
+        large = File(test_directory + '/simple', 'simple')
+        slow = File(test_directory + '/simple', 'simple2')
+        urgent = File(test_directory + '/simple', 'simple2')
+
+        slow.original_path = 'slow'
+        ix.lock_file['slow'] = { 'render_time': 10 }
+        urgent.load_field(('priority', '5'))
+
+        ordered = Pipeline.Ordered(File.rank)
+
+        for file in [ small, Pipeline.done, slow, large, urgent ]:
+            ordered.put(file)
+
+        self.assertEqual([ ordered.get() for _ in range(5) ], [ urgent, slow, large, small, Pipeline.done ])
+        self.assertEqual(urgent.priority, 5)
+
+        # Only so many files wait to be ranked at once
+        bounded = Pipeline.Ordered(File.rank, 2)
+
+        for file in [ small, large ]:
+            bounded.put(file)
+
+        with self.assertRaises(queue.Full):
+            bounded.put(urgent, timeout = 0.01)
+
+        self.assertEqual(bounded.get(), large)
+
+
+    def test_async_pipeline(self):
+        '''
+        Make sure files get found, processed, and added to
+        the lock file with the asyncio backend.
+        '''
+        import ix, threading
+        from ix import Parser, AsyncPipeline
+
+        ix.lock_file = {}
+        ix.config = ix.read_config(test_directory + '/with_prefix/ixrc')
+
+        # Recording happens away from the event loop
+        recorded = []
+        record_file = Parser.record_file
+        Parser.record_file = lambda file: recorded.append(threading.current_thread()) or record_file(file)
+
+        try:
+            AsyncPipeline(4).run(Parser.walk(test_directory + '/with_prefix'), lambda file: file)
+        finally:
+            Parser.record_file = record_file
+
+        self.assertEqual(list(ix.lock_file), [ test_directory + '/with_prefix/prefix' ])
+        self.assertTrue(recorded and threading.main_thread() not in recorded)
+
+        with open(test_directory + '/with_prefix/prefix.ix') as f:
+            self.assertEqual(f.read().count('${{'), 0)
+
+
+    def test_where(self):
+        '''
+        Make sure every file that gets saved is indexed by the config
+        keys and helper expressions it uses, and that files leave the
+        index once they stop using them.
+        '''
+        import ix, tempfile
+        from ix import Parser, Index
+
+        ix.lock_file = {}
+        ix.root_path = test_directory + '/helpers'
+        ix.config = ix.read_config(ix.root_path + '/ixrc')
+
+        source = ix.root_path + '/main'
+
+        with tempfile.TemporaryDirectory() as directory:
+            ix.build(Parser.walk(ix.root_path), directory)
+
+            self.assertIsNone(Index.directory)
+            self.assertEqual(ix.lock_file[source]['keys'], [ 'data.test', 'lowercase data.test', 'uppercase [ data.test ]' ])
+
+            Index.open(directory)
+
+            self.assertEqual(Index.where('data.TEST'), { source: source + '.ix' })
+            self.assertEqual(Index.where('lowercase data.test'), { source: source + '.ix' })
+            self.assertEqual(Index.where('data.other'), {})
+
+            Index.update(source, source + '.ix', ix.lock_file[source]['keys'], [ 'data.other' ])
+            Index.close()
+            Index.open(directory)
+
+            self.assertEqual(Index.where('data.test'), {})
+            self.assertEqual(Index.where('data.other'), { source: source + '.ix' })
+
+            Index.directory = None
+
+
+    def test_incremental(self):
+        '''
+        Make sure a second run over the same lock file skips the
+        files that didn't change, with either backend, and renders
+        the ones that did.
+        '''
+        import ix, tempfile
+        from ix import Parser
+
+        io_backend = ix.io_backend
+
+        for backend in [ 'threads', 'async' ]:
+            with tempfile.TemporaryDirectory() as directory:
+                with open(directory + '/ixrc', 'w') as f:
+                    f.write('[data]\nvalue = one\n')
+
+                for name in [ 'same', 'edited' ]:
+                    with open(directory + '/' + name, 'w') as f:
+                        f.write('#: ix-config\n#{{ data.value }} ' + name + '\n')
+
+                ix.io_backend = backend
+                ix.lock_file = {}
+                ix.root_path = directory
+                ix.config = ix.read_config(directory + '/ixrc')
+
+                try:
+                    ix.build(Parser.walk(directory), directory + '/cache')
+
+                    with open(directory + '/edited', 'a') as f:
+                        f.write('more\n')
+
+                    before = dict(ix.stats)
+                    ix.build(Parser.walk(directory), directory + '/cache')
+                finally:
+                    ix.io_backend = io_backend
+
+                self.assertEqual(ix.stats['unchanged'] - before['unchanged'], 1)
+                self.assertEqual(ix.stats['rendered'] - before['rendered'], 1)
+                self.assertEqual(ix.stats['failed'], before['failed'])
+                self.assertTrue(open(directory + '/edited.ix').read().endswith('more\n'))
+
+
+    def test_plan(self):
+        '''
+        Make sure a plan lists exactly the outputs that a run would
+        create, change, or remove, without reading unchanged files
+        or writing anything.
+        '''
+        import ix, tempfile, json
+        from ix import Parser, Rules
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(directory + '/ixrc', 'w') as f:
+                f.write('[data]\nvalue = one\n')
+
+            for name in [ 'same', 'edited', 'deleted' ]:
+                with open(directory + '/' + name, 'w') as f:
+                    f.write('#: ix-config\n#{{ data.value }} ' + name + '\n')
+
+            ix.lock_file = {}
+            ix.root_path = directory
+            ix.config = ix.read_config(directory + '/ixrc')
+            ix.build(Parser.walk(directory), directory + '/cache')
+
+            self.assertEqual(ix.lock_file[directory + '/same']['stat'], ix.stat_file(directory + '/same'))
+
+            with open(directory + '/edited', 'a') as f:
+                f.write('more\n')
+
+            with open(directory + '/created', 'w') as f:
+                f.write('#: ix-config\nnew\n')
+
+            os.remove(directory + '/deleted')
+
+            lock = dict(ix.lock_file)
+            hashed = []
+            hash_file = ix.hash_file
+            ix.hash_file = lambda path: hashed.append(path) or hash_file(path)
+
+            try:
+                changes = ix.plan()
+            finally:
+                ix.hash_file = hash_file
+
+            self.assertEqual(changes, {
+                'created': [ directory + '/created.ix' ],
+                'changed': [ directory + '/edited.ix' ],
+                'removed': [ directory + '/deleted.ix' ],
+                'unchanged': 1
+            })
+
+            self.assertFalse(directory + '/same' in hashed)
+            self.assertEqual(ix.lock_file, lock)
+            self.assertFalse(os.path.exists(directory + '/created.ix'))
+            self.assertTrue(os.path.exists(directory + '/deleted.ix'))
+
+            # Nothing gets cached either, rules or config
+            with open(directory + '/rules.json', 'w') as f:
+                json.dump({ 'root': directory, 'parse': [ { 'file': directory + '/sam*', 'to': directory } ] }, f)
+
+            lock_path = ix.lock_path
+            ix.lock_path = directory + '/lock'
+            ix.planning = True
+
+            try:
+                ix.read_config([ directory + '/ixrc' ])
+                ix.plan(Rules.read(directory + '/rules.json'))
+            finally:
+                ix.lock_path = lock_path
+                ix.planning = False
+
+            self.assertFalse(os.path.exists(directory + '/lock'))
+
+
+    def test_log(self):
+        '''
+        Make sure messages from many threads all get written out by the
+        single writer, and that missing variables are shown once each,
+        no matter how many files they were missing from.
+        '''
+        import ix, io, json, threading
+        from ix import Log
+
+        # Anything left over from other tests
+        Log.close()
+
+        stream = io.StringIO()
+        Log.stream = stream
+
+        def work(number):
+            for i in range(50):
+                ix.success(f'worker { number } message { i }', True)
+
+            Log.unmatched(f'file{ number }', [ 'a.missing' ] + ([ 'b.rare' ] if number == 0 else []))
+
+        try:
+            threads = [ threading.Thread(target = work, args = (n,)) for n in range(8) ]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+
+            Log.close()
+            lines = stream.getvalue().splitlines()
+
+            for number in range(8):
+                self.assertTrue(any(f'worker { number } message 49' in line for line in lines))
+
+            self.assertEqual(sum('message' in line for line in lines), 400)
+            self.assertEqual(sum('Could not find' in line for line in lines), 2)
+            self.assertTrue('...and 3 more' in stream.getvalue())
+
+            # The same thing, as JSON lines
+            stream.seek(0)
+            stream.truncate()
+            Log.format = 'json'
+
+            work(0)
+            Log.close()
+
+            entries = [ json.loads(line) for line in stream.getvalue().splitlines() ]
+
+            self.assertEqual(len(entries), 52)
+            self.assertEqual(entries[0]['level'], 'success')
+            self.assertEqual(entries[0]['message'], 'worker 0 message 0')
+            self.assertEqual(entries[-1]['variable'], 'b.rare')
+            self.assertEqual(entries[-1]['files'], [ 'file0' ])
+        finally:
+            Log.stream = None
+            Log.format = 'text'
+
+
+    def test_store(self):
+        '''
+        Make sure identical outputs are only stored once and
+        hardlinked to every place they're saved to.
+        '''
+        import ix, tempfile
+        from ix import Store
+
+        lock_path = ix.lock_path
+
+        with tempfile.TemporaryDirectory() as directory:
+            ix.lock_path = directory + '/cache'
+
+            first = Store.materialize(directory + '/first', 'same contents')
+            second = Store.materialize(directory + '/second', 'same contents')
+            third = Store.materialize(directory + '/third', 'same contents', int('755', 8))
+
+            self.assertEqual(first, second)
+            self.assertEqual(first, third)
+            self.assertTrue(os.path.samefile(directory + '/first', directory + '/second'))
+            self.assertFalse(os.path.samefile(directory + '/first', directory + '/third'))
+            self.assertTrue(os.access(directory + '/third', os.X_OK))
+
+            os.remove(directory + '/third')
+            Store.collect()
+
+            self.assertTrue(os.path.exists(Store.path(first)))
+            self.assertFalse(os.path.exists(Store.path(first, int('755', 8))))
+
+        ix.lock_path = lock_path
+
+
+    def test_layered_config(self):
+        '''
+        Make sure later config layers override the earlier ones, that
+        every key knows which layer it came from, and that only the
+        layers that changed get parsed again.
+        '''
+        import ix, tempfile
+
+        lock_path = ix.lock_path
+        base = os.path.abspath(test_directory + '/layered_config/base')
+        host = os.path.abspath(test_directory + '/layered_config/host')
+
+        with tempfile.TemporaryDirectory() as directory:
+            ix.lock_path = directory
+
+            config = ix.read_config([ base, host ])
+
+            # The cache only gets written once the run is done
+            self.assertFalse(os.path.exists(directory + '/config.json'))
+            ix.save_config_cache()
+            self.assertTrue(os.path.exists(directory + '/config.json'))
+
+            self.assertEqual(config.resolved['colors.background'], '#1d1f21')
+            self.assertEqual(config.resolved['colors.border'], '#1d1f21')
+            self.assertEqual(config.resolved['colors.foreground'], '#ffffff')
+            self.assertEqual(config.origin['colors.background'], host)
+            self.assertEqual(config.origin['font.family'], base)
+
+            parsed = []
+            read_config_layer = ix.read_config_layer
+            ix.read_config_layer = lambda path: parsed.append(path) or read_config_layer(path)
+
+            try:
+                cached = ix.read_config([ base, host ])
+                self.assertEqual(parsed, [])
+                self.assertEqual(cached.resolved, config.resolved)
+
+                with open(directory + '/host', 'w') as f:
+                    f.write('[colors]\nforeground = #c5c8c6\n')
+
+                changed = ix.read_config([ base, directory + '/host' ])
+                self.assertEqual(parsed, [ directory + '/host' ])
+                self.assertEqual(changed.resolved['colors.foreground'], '#c5c8c6')
+                self.assertEqual(changed.resolved['colors.background'], '#000000')
+            finally:
+                ix.read_config_layer = read_config_layer
+
+        ix.lock_path = lock_path
+
+
+    def test_rules(self):
+        '''
+        Make sure rules from a JSON lines file get expanded from glob
+        patterns, and that the expanded rules are cached until the
+        rules file or the matched directories change.
+        '''
+        import ix, tempfile, json
+        from ix import Rules, Environment
+
+        lock_path = ix.lock_path
+
+        with tempfile.TemporaryDirectory() as directory:
+            ix.lock_path = directory + '/cache'
+            os.makedirs(directory + '/dots/nested')
+
+            for path in [ '/dots/first', '/dots/nested/second', '/dots/single' ]:
+                with open(directory + path, 'w') as f:
+                    f.write('contents')
+
+            with open(directory + '/rules.jsonl', 'w') as f:
+                f.write(json.dumps({ 'root': directory + '/dots' }) + '\n')
+                f.write(json.dumps({ 'file': directory + '/dots/**/*st', 'to': directory + '/out' }) + '\n')
+                f.write(json.dumps({ 'file': directory + '/dots/single', 'as': 'renamed' }) + '\n')
+
+            rules = Rules.read(directory + '/rules.jsonl')
+            files = [ rule['file'] for rule in rules['parse'] ]
+
+            self.assertEqual(rules['root'], directory + '/dots')
+            self.assertEqual(files, [ directory + '/dots/first', directory + '/dots/single' ])
+            self.assertEqual(rules['parse'][0]['to'], directory + '/out')
+
+            expanded = []
+            expand = Rules.expand
+            Rules.expand = lambda rule: expanded.append(rule) or expand(rule)
+
+            try:
+                self.assertEqual(Rules.read(directory + '/rules.jsonl'), rules)
+                self.assertEqual(expanded, [])
+
+                with open(directory + '/dots/nested/last', 'w') as f:
+                    f.write('contents')
+
+                rules = Rules.read(directory + '/rules.jsonl')
+                files = [ rule['file'] for rule in rules['parse'] ]
+
+                self.assertEqual(len(expanded), 2)
+                self.assertTrue(directory + '/dots/nested/last' in files)
+            finally:
+                Rules.expand = expand
+
+            # Rules using environment variables are expanded again once they change
+            with open(directory + '/environment.jsonl', 'w') as f:
+                f.write(json.dumps({ 'file': '${IX_RULES}/*' }) + '\n')
+
+            try:
+                for folder, expected in [ ('/dots', [ '/dots/first', '/dots/single' ]), ('/dots/nested', [ '/dots/nested/last', '/dots/nested/second' ]) ]:
+                    Environment.variables['IX_RULES'] = directory + folder
+                    files = [ rule['file'] for rule in Rules.read(directory + '/environment.jsonl')['parse'] ]
+
+                    self.assertEqual(files, [ directory + path for path in expected ])
+            finally:
+                del Environment.variables['IX_RULES']
+
+        ix.lock_path = lock_path
+
+
+    def test_git_index(self):
+        '''
+        Make sure files that weren't modified since they were added to
+        the git index are known without reading them, for every index
+        version, and that everything works the usual way outside a repository.
+        '''
+        import ix, tempfile, subprocess
+        from ix import Parser, Git, Pipeline
+
+        lock_path = ix.lock_path
+
+        with tempfile.TemporaryDirectory() as directory:
+            ix.lock_path = directory + '/cache'
+            self.assertFalse(Git.load(directory))
+
+            os.makedirs(directory + '/dots/nested')
+
+            with open(directory + '/dots/nested/main', 'w') as f:
+                f.write('#: ix-config\n#: to: /tmp\n\ncontents\n')
+
+            with open(directory + '/dots/plain', 'w') as f:
+                f.write('plain\n')
+
+            subprocess.run([ 'git', 'init', '-q', directory + '/dots' ], check = True)
+            subprocess.run([ 'git', '-C', directory + '/dots', 'add', '.' ], check = True)
+
+            main = directory + '/dots/nested/main'
+            plain = directory + '/dots/plain'
+            blob = subprocess.run([ 'git', 'hash-object', main ], capture_output = True, text = True).stdout.strip()
+
+            for version in [ '2', '3', '4' ]:
+                subprocess.run([ 'git', '-C', directory + '/dots', 'update-index', '--index-version', version ], check = True)
+
+                self.assertTrue(Git.load(directory + '/dots/nested'))
+                self.assertEqual(Git.blob(main), blob)
+                self.assertIsNotNone(Git.blob(plain))
+
+            sniffed = []
+            wrap_file = Parser.wrap_file
+            Parser.wrap_file = lambda path: sniffed.append(path) or wrap_file(path)
+
+            try:
+                self.assertEqual(Parser.sniff(main).to, '/tmp')
+                self.assertIsNone(Parser.sniff(plain))
+
+                Git.save()
+                Git.load(directory + '/dots')
+
+                file = Parser.sniff(main)
+
+                self.assertEqual((file.to, file.blob), ('/tmp', blob))
+                self.assertIsNone(Parser.sniff(plain))
+                self.assertEqual(sniffed, [ main, plain ])
+
+                with open(plain, 'a') as f:
+                    f.write('modified\n')
+
+                self.assertIsNone(Git.blob(plain))
+                self.assertIsNone(Parser.sniff(plain))
+                self.assertEqual(sniffed, [ main, plain, plain ])
+
+                # The repository itself is never looked at
+                found = Pipeline().source(Parser.walk(directory + '/dots')).stage(Parser.sniff, 2).drain()
+
+                self.assertEqual([ file.original_path for file in found ], [ main ])
+                self.assertFalse(any('/.git/' in path for path in sniffed))
+            finally:
+                Parser.wrap_file = wrap_file
+                Git.entries = None
+                Git.sniffed = {}
+
+        ix.lock_path = lock_path
+
+
+    def test_bundle(self):
+        '''
+        Make sure processed files end up in the archive under their
+        full output path and with their permissions.
+        '''
+        import ix, tempfile, tarfile
+        from ix import Parser, Bundle
+
+        ix.root_path = test_directory + '/with_access'
+        file = Parser.find_ix(ix.root_path).pop()
+
+        with tempfile.TemporaryDirectory() as directory:
+            Bundle.open(directory + '/bundle.tar.gz')
+            Parser.save_file(file, file.render())
+            Bundle.close()
+
+            with tarfile.open(directory + '/bundle.tar.gz') as archive:
+                entry, = archive.getmembers()
+
+                self.assertEqual('/' + entry.name, os.path.abspath(file.get_output_path()))
+                self.assertEqual(entry.mode, int('777', 8))
+                self.assertTrue(b'custom permissions' in archive.extractfile(entry).read())
+
+
+    def test_generations(self):
+        '''
+        Make sure generations get activated by symlinking every
+        output into the current generation, and that rolling back
+        brings the previous contents back.
+        '''
+        import ix, tempfile
+        from ix import Generations
+
+        lock_path = ix.lock_path
+
+        with tempfile.TemporaryDirectory() as directory:
+            ix.lock_path = directory + '/cache'
+            output = directory + '/live/output'
+
+            for contents in [ 'first', 'second' ]:
+                number = Generations.begin()
+
+                os.makedirs(os.path.dirname(ix.destination(output)))
+                with open(ix.destination(output), 'w') as f:
+                    f.write(contents)
+
+                ix.save_lock_file(ix.lock_path, {})
+                Generations.activate(number)
+
+            ix.output_root = None
+
+            self.assertTrue(os.path.islink(output))
+            self.assertEqual(open(output).read(), 'second')
+
+            Generations.rollback()
+            self.assertEqual(open(output).read(), 'first')
+
+        ix.lock_path = lock_path
+
+
+    def test_generations_partial(self):
+        '''
+        Make sure a file that fails in a run keeps its previous
+        output live once the new generation gets activated.
+        '''
+        import ix, tempfile
+        from ix import Parser
+
+        lock_path = ix.lock_path
+        render = Parser.render
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(directory + '/ixrc', 'w') as f:
+                f.write('[data]\nvalue = one\n')
+
+            for name in [ 'good', 'bad' ]:
+                with open(directory + '/' + name, 'w') as f:
+                    f.write(f'#: ix-config\n#: to: { directory }/live\n{ name } first\n')
+
+            ix.lock_path = directory + '/cache'
+            ix.lock_file = {}
+            ix.root_path = directory
+            ix.config = ix.read_config(directory + '/ixrc')
+            ix.generations = True
+
+            try:
+                ix.process_all()
+
+                for name in [ 'good', 'bad' ]:
+                    with open(directory + '/' + name, 'a') as f:
+                        f.write('second\n')
+
+                Parser.render = lambda file, contents = None: None if file.name == 'bad' else render(file, contents)
+                ix.output_root = None
+                ix.process_all()
+            finally:
+                Parser.render = render
+                ix.generations = False
+                ix.output_root = None
+                ix.lock_path = lock_path
+
+            with open(directory + '/live/good') as f:
+                self.assertTrue(f.read().endswith('second\n'))
+
+            with open(directory + '/live/bad') as f:
+                self.assertTrue(f.read().endswith('bad first\n'))
+
+
 if __name__ == '__main__':
     # Windows handles colors weirdly by default
     if os.name == 'nt':
@@ -0,0 +1,12 @@
+pure = True
+calls = []
+
+
+def shout(value, volume = None):
+    calls.append([ value ])
+    return value.upper() + '!'
+
+
+def batch(values, volume = None):
+    calls.append(values)
+    return [ value.upper() + '!' for value in values ]